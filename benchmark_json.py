@@ -0,0 +1,72 @@
+import argparse
+import random
+import time
+
+from slack_export import JsonWriter, orjson
+
+# Compares the JsonWriter styles and backends on synthetic day files: bytes
+# written and seconds spent serializing, both scaled to a million messages.
+
+WORDS = ['deploy', 'review', 'lunch', 'meeting', 'bug', 'release', 'café', 'naïve', 'über', '🚀', '👍',
+         'the', 'a', 'is', 'on', 'for', 'with', 'tomorrow', 'today', 'ticket']
+
+# a message roughly shaped like what conversations.history returns
+def makeMessage(index):
+    ts = 1600000000 + index * 37
+    message = {
+        'type': 'message',
+        'ts': '%d.%06d' % (ts, index % 1000000),
+        'user': 'U%08d' % random.randrange(500),
+        'text': ' '.join(random.choice(WORDS) for _ in range(random.randrange(3, 40))),
+        'team': 'T00000000',
+        'blocks': [{'type': 'rich_text', 'block_id': 'b%d' % index, 'elements': []}],
+    }
+    if index % 5 == 0:
+        message['reactions'] = [{'name': 'thumbsup', 'users': ['U00000001', 'U00000002'], 'count': 2}]
+    if index % 11 == 0:
+        message['thread_ts'] = message['ts']
+        message['reply_count'] = random.randrange(1, 20)
+    if index % 29 == 0:
+        message['files'] = [{
+            'id': 'F%08d' % index,
+            'name': 'screenshot.png',
+            'mimetype': 'image/png',
+            'size': random.randrange(10000, 2000000),
+            'url_private': 'https://files.slack.com/files-pri/T00000000-F%08d/screenshot.png' % index,
+            'thumb_360': 'https://files.slack.com/files-tmb/T00000000-F%08d/screenshot_360.png' % index,
+        }]
+    return message
+
+# splits messages in day files of messagesPerDay messages
+def makeDays(messages, messagesPerDay):
+    return [messages[i:i + messagesPerDay] for i in range(0, len(messages), messagesPerDay)]
+
+def benchmark(writer, days, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        written = sum(len(writer.dumps(day)) for day in days)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return written, best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the JSON writers of slack_export.py')
+    parser.add_argument('--messages', type=int, default=100000, help="Number of messages to serialize (default: 100000)")
+    parser.add_argument('--messagesPerDay', type=int, default=200, help="Messages per day file (default: 200)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per writer, the fastest is reported (default: 3)")
+    args = parser.parse_args()
+
+    random.seed(0)
+    days = makeDays([makeMessage(index) for index in range(args.messages)], args.messagesPerDay)
+    scale = 1000000 / args.messages
+
+    backends = ['json'] + (['orjson'] if orjson is not None else [])
+    print("{0:<8} {1:<8} {2:>14} {3:>14}".format('backend', 'style', 'MB/M messages', 's/M messages'))
+    for backend in backends:
+        for style in JsonWriter.styles:
+            written, elapsed = benchmark(JsonWriter(style, backend), days, args.repeat)
+            print("{0:<8} {1:<8} {2:>14.1f} {3:>14.2f}".format(
+                backend, style, written * scale / (1024 * 1024), elapsed * scale))
+    if orjson is None:
+        print("(orjson is not installed, pip install orjson to compare it)")
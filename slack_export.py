@@ -4,13 +4,36 @@ import os
 import io
 import shutil
 import copy
+import gzip
 import sys
-from datetime import datetime
+import asyncio
+import hashlib
+import heapq
+import re
+from fnmatch import fnmatch
+import sqlite3
+import tempfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as waitForFutures
+from datetime import datetime, timezone
 from pick import pick
 from time import sleep
 from urllib.parse import urlparse
 import requests
 
+# orjson is optional, and only makes writing the export faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# zstandard is optional, and only needed for --compress zstd
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 #################### Patched - Slacker ######################
 # Purpose of the patch is to allow for a cookie header to be set
@@ -33,21 +56,37 @@ import requests
 import json
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 
+import socket
+import threading
 import time
 
+# Patched
+# aiohttp is only needed for AsyncSlacker
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+API_URL = 'https://slack.com/api/'
+
 ###### Slacker Utils ######
-def get_api_url(method):
+def get_api_url(method, api_url=API_URL):
     """
     Returns API URL for the given method.
 
     :param method: Method name
     :type method: str
 
+    :param api_url: Base URL of the API, e.g. a local mock server's
+    :type api_url: str
+
     :returns: API URL for the given method
     :rtype: str
     """
-    return 'https://slack.com/api/{}'.format(method)
+    return '{}{}'.format(api_url, method)
 
 
 def get_item_id_by_name(list_dict, key_name):
@@ -55,61 +94,371 @@ def get_item_id_by_name(list_dict, key_name):
         if d['name'] == key_name:
             return d['id']
 
+
+# Patched
+def index_by_name(list_dict):
+    """
+    Maps the names of the given users or channels to their IDs, for lookups
+    that would otherwise scan the whole listing each time.
+    """
+    return {d['name']: d['id'] for d in list_dict}
+
+
+def keep_alive_socket_options(idle):
+    """
+    Returns socket options turning on TCP keep-alive after `idle` seconds.
+    """
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    # not every platform lets the probe timings be tuned
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle))
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, idle))
+    return options
+
 ###########################
 
 
 __version__ = '0.14.0'
 
 DEFAULT_TIMEOUT = 10
-DEFAULT_RETRIES = 0
+DEFAULT_RETRIES = 5
 # seconds to wait after a 429 error if Slack's API doesn't provide one
 DEFAULT_WAIT = 20
+# connections kept open per host by the shared session
+DEFAULT_POOL_SIZE = 10
+# seconds an idle connection waits before TCP keep-alive probes are sent
+DEFAULT_KEEP_ALIVE = 60
+# connections the async client opens to each host
+DEFAULT_ASYNC_CONNECTIONS = 100
+# seconds an idle connection of the async client is kept for reuse (aiohttp's default)
+DEFAULT_ASYNC_KEEP_ALIVE = 15
 
-__all__ = ['Error', 'Response', 'BaseAPI', 'API', 'Auth', 'Users', 'Groups',
+# Patched
+# Requests per minute allowed by Slack's rate limit tiers
+# https://api.slack.com/docs/rate-limits
+RATE_LIMIT_TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+DEFAULT_TIER = 3
+
+# Name of the bucket used for downloads from files.slack.com, which are not
+# API methods but are still throttled by Slack
+FILE_DOWNLOADS = 'files.download'
+
+# Requests per minute for the methods the exporter leans on; any other method
+# gets the default tier
+METHOD_RATE_LIMITS = {
+    'conversations.history': RATE_LIMIT_TIERS[3],
+    'conversations.replies': RATE_LIMIT_TIERS[3],
+    'conversations.members': RATE_LIMIT_TIERS[4],
+    'users.list': RATE_LIMIT_TIERS[2],
+    'users.info': RATE_LIMIT_TIERS[4],
+    'conversations.list': RATE_LIMIT_TIERS[2],
+    'files.list': RATE_LIMIT_TIERS[3],
+    FILE_DOWNLOADS: 600,
+}
+
+__all__ = ['Error', 'Response', 'TokenBucket', 'RateLimiter', 'BaseAPI', 'API', 'Auth', 'Users', 'Groups',
            'Channels', 'Chat', 'IM', 'IncomingWebhook', 'Search', 'Files',
            'Stars', 'Emoji', 'Presence', 'RTM', 'Team', 'Reactions', 'Pins',
            'UserGroups', 'UserGroupsUsers', 'MPIM', 'OAuth', 'DND', 'Bots',
            'FilesComments', 'Reminders', 'TeamProfile', 'UsersProfile',
            'IDPGroups', 'Apps', 'AppsPermissions', 'Slacker', 'Dialog',
-           'Conversations', 'Migration']
+           'Conversations', 'Migration', 'KeepAliveAdapter', 'create_session',
+           'AsyncBaseAPI', 'AsyncConversations', 'AsyncUsers', 'AsyncFiles',
+           'AsyncSlacker']
 
 
 class Error(Exception):
     pass
 
 
+# Patched
+# Decodes JSON with orjson when it's installed, which is faster
+def decode_json(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+# Patched
 class Response(object):
-    def __init__(self, body):
-        self.raw = body
-        self.body = json.loads(body)
-        self.successful = self.body['ok']
-        self.error = self.body.get('error')
+    """
+    Response of the Slack API, whose body is only decoded when it's used.
+
+    :param body: Text of the HTTP response
+    :type body: str
+
+    :param keep_raw: Keep the text as `raw` once the body is decoded, rather
+        than dropping it so the page isn't held in memory twice
+    :type keep_raw: bool
+    """
+    def __init__(self, body, keep_raw=False):
+        self._text = body
+        self._body = None
+        self.raw = body if keep_raw else None
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = decode_json(self._text)
+            self._text = None
+        return self._body
+
+    @property
+    def successful(self):
+        # Slack's responses start like this, which spares decoding the body
+        # just to find out
+        if self._text is not None and self._text.startswith('{"ok":true'):
+            return True
+        return self.body['ok']
+
+    @property
+    def error(self):
+        return self.body.get('error')
+
+    def iter_items(self, key):
+        """
+        Decodes the list stored under `key` one item at a time, so that a
+        large page is handed over without ever being decoded as a whole.
+        Once done, `body` holds the other fields of the response (without
+        `key`).
+
+        :param key: Name of the list, e.g. 'messages'
+        :type key: str
+        """
+        if self._text is None:
+            for item in self.body.get(key, []):
+                yield item
+            return
+
+        text = self._text
+        rest = {}
+        index = self._expect(text, 0, '{')
+        closed = text.startswith('}', index)
+        if closed:
+            index = self._expect(text, index, '}')
+        while not closed:
+            name, index = _json_decoder.raw_decode(text, index)
+            index = self._expect(text, self._skip(text, index), ':')
+            if name == key and text.startswith('[', index):
+                index = self._expect(text, index, '[')
+                done = text.startswith(']', index)
+                if done:
+                    index = self._expect(text, index, ']')
+                while not done:
+                    item, index = _json_decoder.raw_decode(text, index)
+                    yield item
+                    index = self._skip(text, index)
+                    done = text.startswith(']', index)
+                    index = self._expect(text, index, ',]')
+            else:
+                rest[name], index = _json_decoder.raw_decode(text, index)
+            index = self._skip(text, index)
+            closed = text.startswith('}', index)
+            index = self._expect(text, index, ',}')
+
+        self._body = rest
+        self._text = None
+
+    @staticmethod
+    def _skip(text, index):
+        return _json_whitespace.match(text, index).end()
+
+    # checks that one of chars is at index, returns the index of what follows
+    # (and its whitespace)
+    @staticmethod
+    def _expect(text, index, chars):
+        if index >= len(text) or text[index] not in chars:
+            raise ValueError('Expecting one of %r at char %d' % (chars, index))
+        return Response._skip(text, index + 1)
 
     def __str__(self):
+        if self.raw is not None:
+            return self.raw
+        if self._text is not None:
+            return self._text
         return json.dumps(self.body)
 
 
+# Patched
+class TokenBucket(object):
+    """
+    Token bucket refilled at a constant rate.
+
+    :param rate: Tokens added per second
+    :type rate: float
+
+    :param capacity: Maximum number of tokens, i.e. the allowed burst
+    :type capacity: int
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+    def reserve(self):
+        """
+        Takes a token from the bucket.
+
+        :returns: Seconds the caller has to wait before using the token
+        :rtype: float
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            # the bucket doesn't refill while it is paused
+            wait = max(0.0, self.updated - now)
+            if self.tokens < 0:
+                wait += -self.tokens / self.rate
+            return wait
+
+    def pause(self, seconds):
+        """
+        Stops handing out tokens for the given number of seconds.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now + seconds > self.updated:
+                self.updated = now + seconds
+                self.tokens = min(self.tokens, 0)
+
+    def paused_for(self):
+        """
+        :returns: Seconds left before the current pause ends, 0 if the bucket
+            isn't paused
+        :rtype: float
+        """
+        with self.lock:
+            return max(0.0, self.updated - time.monotonic())
+
+
+# Patched
+class RateLimiter(object):
+    """
+    Holds one token bucket per Slack method, shared by every caller.
+
+    :param rates: Requests per minute by method name, overriding
+        METHOD_RATE_LIMITS
+    :type rates: dict
+    """
+    def __init__(self, rates=None):
+        self.rates = dict(METHOD_RATE_LIMITS, **(rates or {}))
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, method):
+        with self.lock:
+            if method not in self.buckets:
+                per_minute = self.rates.get(method,
+                                            RATE_LIMIT_TIERS[DEFAULT_TIER])
+                self.buckets[method] = TokenBucket(per_minute / 60.0,
+                                                   max(1, per_minute // 10))
+            return self.buckets[method]
+
+    def acquire(self, method):
+        bucket = self.bucket(method)
+        wait = bucket.reserve()
+        # the bucket may have been paused (by a 429) while the caller waited
+        # for its token, in which case it waits for the pause to end too
+        while wait > 0:
+            sleep(wait)
+            wait = bucket.paused_for()
+
+    def pause(self, method, seconds):
+        self.bucket(method).pause(seconds)
+
+
+# Patched
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose pooled connections use TCP keep-alive.
+
+    :param keep_alive: Idle seconds before keep-alive probes are sent, or 0
+        to use the system defaults
+    :type keep_alive: int
+    """
+    def __init__(self, keep_alive=DEFAULT_KEEP_ALIVE, **kwargs):
+        # init_poolmanager is called from HTTPAdapter.__init__
+        self.keep_alive = keep_alive
+        super(KeepAliveAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive:
+            kwargs['socket_options'] = (
+                HTTPConnection.default_socket_options +
+                keep_alive_socket_options(self.keep_alive)
+            )
+        super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, keep_alive=DEFAULT_KEEP_ALIVE):
+    """
+    Returns a requests session reusing up to `pool_size` connections per
+    host. The pool blocks rather than opening throwaway connections when
+    more threads than that share the session.
+    """
+    session = requests.Session()
+    adapter = KeepAliveAdapter(keep_alive=keep_alive,
+                               pool_connections=pool_size,
+                               pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 # Patched
 # Pass the headers along to the requests call
 class BaseAPI(object):
     def __init__(self, token=None, headers=None, timeout=DEFAULT_TIMEOUT, proxies=None,
-                 session=None, rate_limit_retries=DEFAULT_RETRIES):
+                 session=None, rate_limit_retries=DEFAULT_RETRIES,
+                 rate_limiter=None, api_url=API_URL, keep_raw=False):
         self.headers = headers
         self.token = token
         self.timeout = timeout
         self.proxies = proxies
         self.session = session
         self.rate_limit_retries = rate_limit_retries
+        self.rate_limiter = rate_limiter
+        self.api_url = api_url
+        self.keep_raw = keep_raw
+
+    def _throttle(self, method):
+        if self.rate_limiter:
+            self.rate_limiter.acquire(method)
+
+    def _back_off(self, method, seconds):
+        # with a shared limiter, only this method's bucket is paused, for
+        # every caller
+        if self.rate_limiter:
+            self.rate_limiter.pause(method, seconds)
+        else:
+            sleep(seconds)
 
     def _request(self, request_method, method, **kwargs):
         if self.token:
             kwargs.setdefault('params', {})['token'] = self.token
             kwargs['headers'] = self.headers
-        url = get_api_url(method)
+        url = get_api_url(method, self.api_url)
 
         # while we have rate limit retries left, fetch the resource and back
         # off as Slack's HTTP response suggests
         for retry_num in range(self.rate_limit_retries):
+            self._throttle(method)
             response = request_method(
                 url, timeout=self.timeout, proxies=self.proxies, **kwargs
             )
@@ -120,7 +469,7 @@ class BaseAPI(object):
             # handle HTTP 429 as documented at
             # https://api.slack.com/docs/rate-limits
             if response.status_code == requests.codes.too_many:
-                sleep(1 + int(
+                self._back_off(method, 1 + int(
                     response.headers.get('retry-after', DEFAULT_WAIT)
                 ))
                 continue
@@ -129,12 +478,13 @@ class BaseAPI(object):
         else:
             # with no retries left, make one final attempt to fetch the
             # resource, but do not handle too_many status differently
+            self._throttle(method)
             response = request_method(
                 url, timeout=self.timeout, proxies=self.proxies, **kwargs
             )
             response.raise_for_status()
 
-        response = Response(response.text)
+        response = Response(response.text, self.keep_raw)
         if not response.successful:
             raise Error(response.error)
 
@@ -351,6 +701,8 @@ class Users(BaseAPI):
         super(Users, self).__init__(*args, **kwargs)
         self._profile = UsersProfile(*args, **kwargs)
         self._admin = UsersAdmin(*args, **kwargs)
+        # name -> ID index of every user, built on the first get_user_id
+        self._ids_by_name = None
 
     @property
     def profile(self):
@@ -364,8 +716,10 @@ class Users(BaseAPI):
         return self.get('users.info',
                         params={'user': user, 'include_locale': include_locale})
 
-    def list(self, presence=False):
-        return self.get('users.list', params={'presence': int(presence)})
+    def list(self, presence=False, cursor=None, limit=None):
+        return self.get('users.list',
+                        params={'presence': int(presence), 'cursor': cursor,
+                                'limit': limit})
 
     def identity(self):
         return self.get('users.identity')
@@ -379,9 +733,29 @@ class Users(BaseAPI):
     def set_presence(self, presence):
         return self.post('users.setPresence', data={'presence': presence})
 
+    # Patched
+    def list_all(self, limit=1000):
+        """
+        Lists every user, following the cursor from page to page.
+
+        :param limit: Users asked for in each page
+        :type limit: int
+        """
+        members, cursor = [], None
+        while True:
+            body = self.list(cursor=cursor, limit=limit).body
+            members.extend(body['members'])
+            cursor = body.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return members
+
+    # Patched
     def get_user_id(self, user_name):
-        members = self.list().body['members']
-        return get_item_id_by_name(members, user_name)
+        # the users are listed once: a name missing from the index doesn't
+        # belong to any of them
+        if self._ids_by_name is None:
+            self._ids_by_name = index_by_name(self.list_all())
+        return self._ids_by_name.get(user_name)
 
 
 class Groups(BaseAPI):
@@ -453,6 +827,11 @@ class Groups(BaseAPI):
 
 
 class Channels(BaseAPI):
+    def __init__(self, *args, **kwargs):
+        super(Channels, self).__init__(*args, **kwargs)
+        # name -> ID index of every channel, built on the first get_channel_id
+        self._ids_by_name = None
+
     def create(self, name):
         return self.post('channels.create', data={'name': name})
 
@@ -516,9 +895,34 @@ class Channels(BaseAPI):
         return self.post('channels.setTopic',
                          data={'channel': channel, 'topic': topic})
 
+    # Patched
+    def list_all(self, limit=1000):
+        """
+        Lists every public channel with conversations.list (channels.list
+        isn't paginated, and is retired), following the cursor from page to
+        page.
+
+        :param limit: Channels asked for in each page
+        :type limit: int
+        """
+        channels, cursor = [], None
+        while True:
+            body = self.get('conversations.list',
+                            params={'cursor': cursor,
+                                    'types': 'public_channel',
+                                    'limit': limit}).body
+            channels.extend(body['channels'])
+            cursor = body.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return channels
+
+    # Patched
     def get_channel_id(self, channel_name):
-        channels = self.list().body['channels']
-        return get_item_id_by_name(channels, channel_name)
+        # the channels are listed once: a name missing from the index doesn't
+        # belong to any of them
+        if self._ids_by_name is None:
+            self._ids_by_name = index_by_name(self.list_all())
+        return self._ids_by_name.get(channel_name)
 
 
 class Chat(BaseAPI):
@@ -768,6 +1172,38 @@ class Files(BaseAPI):
         return self.get('files.info',
                         params={'file': file_, 'count': count, 'page': page})
 
+    # Patched
+    def download(self, url, stream=False, headers=None):
+        """
+        Fetches a file hosted on files.slack.com, authenticating with the
+        token and headers (e.g. the cookie) the client was created with.
+
+        The file is requested without any content encoding, so the bytes
+        received (and Range offsets) are those of the file itself.
+
+        :param headers: Extra headers, e.g. a Range to resume a download
+        :type headers: dict
+        """
+        headers = dict(self.headers or {}, **(headers or {}))
+        headers['Authorization'] = 'Bearer {}'.format(self.token)
+        headers.setdefault('Accept-Encoding', 'identity')
+        get = self.session.get if self.session else requests.get
+
+        for retry_num in range(self.rate_limit_retries + 1):
+            self._throttle(FILE_DOWNLOADS)
+            response = get(url, headers=headers, timeout=self.timeout,
+                           proxies=self.proxies, stream=stream)
+            if (response.status_code != requests.codes.too_many or
+                    retry_num == self.rate_limit_retries):
+                break
+            response.close()
+            self._back_off(FILE_DOWNLOADS, 1 + int(
+                response.headers.get('retry-after', DEFAULT_WAIT)
+            ))
+
+        response.raise_for_status()
+        return response
+
     def upload(self, file_=None, content=None, filetype=None, filename=None,
                title=None, initial_comment=None, channels=None, thread_ts=None):
         if isinstance(channels, (tuple, list)):
@@ -1225,9 +1661,16 @@ class Slacker(object):
 
     def __init__(self, token, headers=None, incoming_webhook_url=None,
                  timeout=DEFAULT_TIMEOUT, http_proxy=None, https_proxy=None,
-                 session=None, rate_limit_retries=DEFAULT_RETRIES):
+                 session=None, rate_limit_retries=DEFAULT_RETRIES,
+                 rate_limiter=None, pool_size=DEFAULT_POOL_SIZE,
+                 keep_alive=DEFAULT_KEEP_ALIVE, api_url=API_URL,
+                 keep_raw=False):
 
         proxies = self.__create_proxies(http_proxy, https_proxy)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # one pooled session is shared by every namespace below
+        self.session = session or create_session(pool_size, keep_alive)
+        session = self.session
         api_args = {
             'headers': headers,
             'token': token,
@@ -1235,6 +1678,9 @@ class Slacker(object):
             'proxies': proxies,
             'session': session,
             'rate_limit_retries': rate_limit_retries,
+            'rate_limiter': self.rate_limiter,
+            'api_url': api_url,
+            'keep_raw': keep_raw,
         }
         self.im = IM(**api_args)
         self.api = API(**api_args)
@@ -1273,180 +1719,897 @@ class Slacker(object):
             proxies['https'] = https_proxy
         return proxies
 
+
+# Patched
+class AsyncBaseAPI(BaseAPI):
+    """
+    BaseAPI whose get and post return coroutines, sent through an
+    aiohttp.ClientSession.
+
+    The async namespaces list the matching sync namespace first among their
+    bases, so they keep its methods (and parameters) as is while those
+    methods' calls to get/post land here.
+    """
+    async def _throttle(self, method):
+        if self.rate_limiter:
+            bucket = self.rate_limiter.bucket(method)
+            wait = bucket.reserve()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = bucket.paused_for()
+
+    async def _back_off(self, method, seconds):
+        if self.rate_limiter:
+            self.rate_limiter.pause(method, seconds)
+        else:
+            await asyncio.sleep(seconds)
+
+    def _headers(self):
+        return {key: value for key, value in (self.headers or {}).items()
+                if value is not None}
+
+    @staticmethod
+    def _encode(values):
+        # aiohttp only takes strings, and doesn't drop None like requests
+        if not values:
+            return values
+        return {key: str(int(value)) if isinstance(value, bool) else str(value)
+                for key, value in values.items() if value is not None}
+
+    async def _request(self, request_method, method, params=None, data=None,
+                       files=None):
+        params = self._encode(params) or {}
+        if self.token:
+            params['token'] = self.token
+        data = self._encode(data)
+        if files:
+            form = aiohttp.FormData(data or {})
+            for name, file_ in files.items():
+                form.add_field(name, file_)
+            data = form
+        url = get_api_url(method, self.api_url)
+
+        for retry_num in range(self.rate_limit_retries + 1):
+            await self._throttle(method)
+            async with self.session.request(
+                request_method, url, params=params, data=data,
+                headers=self._headers()
+            ) as response:
+                if (response.status == requests.codes.too_many and
+                        retry_num < self.rate_limit_retries):
+                    await self._back_off(method, 1 + int(
+                        response.headers.get('retry-after', DEFAULT_WAIT)
+                    ))
+                    continue
+
+                response.raise_for_status()
+                text = await response.text()
+                break
+
+        response = Response(text, self.keep_raw)
+        if not response.successful:
+            raise Error(response.error)
+
+        return response
+
+    def get(self, api, **kwargs):
+        return self._request('GET', api, **kwargs)
+
+    def post(self, api, **kwargs):
+        return self._request('POST', api, **kwargs)
+
+
+class AsyncConversations(Conversations, AsyncBaseAPI):
+    pass
+
+
+class AsyncUsersProfile(UsersProfile, AsyncBaseAPI):
+    pass
+
+
+class AsyncUsersAdmin(UsersAdmin, AsyncBaseAPI):
+    pass
+
+
+class AsyncUsers(Users, AsyncBaseAPI):
+    def __init__(self, *args, **kwargs):
+        super(AsyncUsers, self).__init__(*args, **kwargs)
+        self._profile = AsyncUsersProfile(*args, **kwargs)
+        self._admin = AsyncUsersAdmin(*args, **kwargs)
+
+    # Patched
+    async def list_all(self, limit=1000):
+        members, cursor = [], None
+        while True:
+            body = (await self.list(cursor=cursor, limit=limit)).body
+            members.extend(body['members'])
+            cursor = body.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return members
+
+    # Patched
+    async def get_user_id(self, user_name):
+        if self._ids_by_name is None:
+            self._ids_by_name = index_by_name(await self.list_all())
+        return self._ids_by_name.get(user_name)
+
+
+class AsyncFilesComments(FilesComments, AsyncBaseAPI):
+    pass
+
+
+class AsyncFiles(Files, AsyncBaseAPI):
+    def __init__(self, *args, **kwargs):
+        super(AsyncFiles, self).__init__(*args, **kwargs)
+        self._comments = AsyncFilesComments(*args, **kwargs)
+
+    async def download(self, url, file_, chunk_size=1024 * 1024, offset=0):
+        """
+        Streams a file hosted on files.slack.com into the given binary file
+        object, which is written to on the loop's default executor rather
+        than on the event loop.
+
+        :param offset: Bytes of the file already in file_ (opened for
+            appending), the rest being requested with a Range header. If
+            the server sends the whole file instead, file_ is truncated.
+        :type offset: int
+
+        :returns: Number of bytes written, and the size of the whole file
+            announced by the server (None if it didn't)
+        :rtype: tuple
+        """
+        loop = asyncio.get_running_loop()
+        headers = self._headers()
+        headers['Authorization'] = 'Bearer {}'.format(self.token)
+        # like Files.download, no content encoding that aiohttp would decode
+        headers.setdefault('Accept-Encoding', 'identity')
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+
+        for retry_num in range(self.rate_limit_retries + 1):
+            await self._throttle(FILE_DOWNLOADS)
+            async with self.session.get(url, headers=headers) as response:
+                if (response.status == requests.codes.too_many and
+                        retry_num < self.rate_limit_retries):
+                    await self._back_off(FILE_DOWNLOADS, 1 + int(
+                        response.headers.get('retry-after', DEFAULT_WAIT)
+                    ))
+                    continue
+
+                # nothing left to fetch past the offset
+                if (offset and response.status ==
+                        requests.codes.range_not_satisfiable):
+                    return 0, offset
+                response.raise_for_status()
+                if response.status == requests.codes.partial_content:
+                    size = response.headers.get('Content-Range', '')
+                    size = size.rpartition('/')[2]
+                else:
+                    size = response.headers.get('Content-Length')
+                    if offset:
+                        await loop.run_in_executor(None, file_.truncate, 0)
+                written = 0
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    await loop.run_in_executor(None, file_.write, chunk)
+                    written += len(chunk)
+                return written, int(size) if size and size.isdigit() else None
+
+    async def upload(self, file_=None, content=None, filetype=None,
+                     filename=None, title=None, initial_comment=None,
+                     channels=None, thread_ts=None):
+        # Files.upload closes a file it opened itself as soon as it returns,
+        # which is before the request is sent here
+        if isinstance(file_, str):
+            with open(file_, 'rb') as f:
+                return await self.upload(f, content, filetype, filename, title,
+                                         initial_comment, channels, thread_ts)
+
+        return await super(AsyncFiles, self).upload(
+            file_, content, filetype, filename, title, initial_comment,
+            channels, thread_ts
+        )
+
+
+# Patched
+class AsyncSlacker(object):
+    """
+    Coroutine-based client for the conversations, users and files
+    namespaces, sharing one pooled aiohttp session.
+
+    pool_size limits the connections opened to each host, and keep_alive is
+    the number of seconds an idle connection is kept for reuse (unlike
+    Slacker's, which delays TCP keep-alive probes).
+
+    The session has to be created on a running event loop, so the namespaces
+    only exist once the client is opened::
+
+        async with AsyncSlacker(token) as slack:
+            history = await slack.conversations.history(channel_id)
+    """
+    def __init__(self, token, headers=None, timeout=DEFAULT_TIMEOUT,
+                 rate_limit_retries=DEFAULT_RETRIES, rate_limiter=None,
+                 pool_size=DEFAULT_ASYNC_CONNECTIONS,
+                 keep_alive=DEFAULT_ASYNC_KEEP_ALIVE, api_url=API_URL,
+                 keep_raw=False):
+        if aiohttp is None:
+            raise Error('AsyncSlacker requires aiohttp (pip install aiohttp)')
+
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.session = None
+        self.api_args = {
+            'headers': headers,
+            'token': token,
+            'timeout': timeout,
+            'rate_limit_retries': rate_limit_retries,
+            'rate_limiter': self.rate_limiter,
+            'api_url': api_url,
+            'keep_raw': keep_raw,
+        }
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size, limit_per_host=self.pool_size,
+            keepalive_timeout=self.keep_alive
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, trust_env=True,
+            # like requests' timeout, this limits connecting and each read
+            # rather than the whole request, which a large download outlasts
+            timeout=aiohttp.ClientTimeout(
+                total=None, sock_connect=self.api_args['timeout'],
+                sock_read=self.api_args['timeout']
+            )
+        )
+        api_args = dict(self.api_args, session=self.session)
+        self.users = AsyncUsers(**api_args)
+        self.files = AsyncFiles(**api_args)
+        self.conversations = AsyncConversations(**api_args)
+        return self
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
 ##################################################################
 
-# Obtains all replies for a given channel id + a starting timestamp
-# Duplicates the logic in getHistory
-def getReplies(channelId, timestamp, pageSize=1000):
-    conversationObject = slack.conversations
-    messages = []
-    lastTimestamp = None
-    lastTimestampFromPreviousIteration = lastTimestamp
+# where --downloadSlackFiles stores files, relative to the export directory
+FILES_DIRECTORY = "../files.slack.com"
 
-    while True:
-        try:
-            response = conversationObject.replies(
-                channel=channelId,
-                ts=timestamp,
-                latest=lastTimestamp,
-                oldest=0,
-                limit=pageSize,
-            ).body
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 429:
-                retryInSeconds = int(e.response.headers["Retry-After"])
-                print("Rate limit hit. Retrying in {0} second{1}.".format(retryInSeconds, "s" if retryInSeconds > 1 else ""))
-                sleep(retryInSeconds + 1)
-
-                response = conversationObject.replies(
-                    channel=channelId,
-                    ts=timestamp,
-                    latest=lastTimestamp,
-                    oldest=0,
-                    limit=pageSize,
-                ).body
-
-        messages.extend(response["messages"])
-
-        if response["has_more"] == True:
-            sys.stdout.write(".")
+# where planDirectories moves the directories of renamed conversations aside,
+# relative to the export directory
+RENAMES_DIRECTORY = ".renames"
+
+# bytes of serialized messages getHistory keeps in memory before spilling
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# days since a thread started during which --incremental checks it for new replies
+DEFAULT_THREAD_LOOKBACK = 30
+
+# users per page of users.list
+USERS_PAGE_SIZE = 1000
+
+# options deciding what an export holds and how it's written, which --resume
+# takes from the export it continues
+RESUMED_OPTIONS = ('publicChannels', 'groups', 'directMessages', 'excludeArchived', 'excludeNonMember',
+                   'filesOnly', 'filesFrom', 'filesTo', 'downloadSlackFiles', 'jsonStyle', 'compress')
+
+class ZipExport(object):
+    """
+    Streams the files of the export into a zip archive as they are written (ZIP64, so
+    there's no limit on its size or number of files), instead of writing them to the
+    export directory and zipping it once done. Safe to write to from several threads.
+
+    Downloaded files included with includeFile are added when the archive is closed,
+    once the downloads are finished; formats that are already compressed are stored
+    as they are rather than deflated again.
+    """
+    storedExtensions = {
+        '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp4', '.mov', '.m4v', '.webm',
+        '.mp3', '.m4a', '.aac', '.ogg', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+        '.docx', '.xlsx', '.pptx',
+    }
+
+    def __init__(self, fileName):
+        self.zipFile = zipfile.ZipFile(fileName, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.lock = threading.Lock()
+        self.included = {}
+
+    def compressionFor(self, arcName):
+        if os.path.splitext(arcName)[1].lower() in self.storedExtensions:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    # fileName is relative to the export directory
+    def writeData(self, fileName, data):
+        arcName = os.path.normpath(fileName)
+        with self.lock:
+            self.zipFile.writestr(arcName, data, compress_type=self.compressionFor(arcName))
+
+    def includeFile(self, path, arcName):
+        with self.lock:
+            self.included[os.path.normpath(arcName)] = os.path.abspath(path)
+
+    def close(self):
+        with self.lock:
+            for arcName, path in sorted(self.included.items()):
+                # failed downloads are left out
+                if os.path.exists(path):
+                    self.zipFile.write(path, arcName, compress_type=self.compressionFor(arcName))
+            self.zipFile.close()
+
+class JsonWriter(object):
+    """
+    Serializes the JSON files of the export (day files, channels.json, users.json, ...) as UTF-8.
+
+    style is "pretty" (indented, as slack-export-viewer users are used to reading them) or
+    "compact" (no whitespace at all, about half the size). backend is "json" or "orjson",
+    which is several times faster but can only indent by 2 spaces rather than 4: by default,
+    orjson writes the compact style when it's installed, and json the pretty one, so that
+    pretty files are always indented the same way.
+
+    With compression ("gzip" or "zstd"), each file is compressed on its own and gets a .json.gz
+    or .json.zst extension instead of .json. readJsonFile reads any of them.
+
+    With an archive (a ZipExport), files are written to it instead of the export directory.
+    """
+    styles = ('pretty', 'compact')
+    extensions = {None: '.json', 'gzip': '.json.gz', 'zstd': '.json.zst'}
+
+    def __init__(self, style='pretty', backend=None, archive=None, compression=None):
+        if backend is None:
+            backend = 'orjson' if style == 'compact' and orjson is not None else 'json'
+        if backend == 'orjson' and orjson is None:
+            raise ValueError("the orjson backend requires orjson (pip install orjson)")
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression requires zstandard (pip install zstandard)")
+        self.style = style
+        self.backend = backend
+        self.archive = archive
+        self.compression = compression
+
+    def dumps(self, data):
+        if self.backend == 'orjson':
+            return orjson.dumps(data, option=orjson.OPT_INDENT_2 if self.style == 'pretty' else 0)
+        if self.style == 'pretty':
+            return json.dumps(data, indent=4, ensure_ascii=False).encode('utf-8')
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def compress(self, data):
+        if self.compression == 'gzip':
+            return gzip.compress(data, compresslevel=6)
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        return data
+
+    # the name a JSON file of the export is written under, fileName being
+    # named as any JSON file (e.g. users.json, or users.json.gz)
+    def fileName(self, fileName):
+        return jsonBaseName(fileName) + self.extensions[self.compression]
+
+    # returns the name the file was written under
+    def write(self, fileName, data):
+        fileName = self.fileName(fileName)
+        data = self.compress(self.dumps(data))
+        if self.archive:
+            self.archive.writeData(fileName, data)
+            return fileName
+        # write to a temporary file first so a crash can't leave a truncated file
+        tmpFileName = fileName + '.tmp'
+        with open(tmpFileName, 'wb') as outFile:
+            outFile.write(data)
+        os.replace(tmpFileName, fileName)
+
+        # a previous export may have written it with another --compress
+        for extension in self.extensions.values():
+            otherFileName = jsonBaseName(fileName) + extension
+            if otherFileName != fileName and os.path.exists(otherFileName):
+                os.remove(otherFileName)
+        return fileName
+
+# the name of a JSON file of the export without its extension (.json, .json.gz or .json.zst)
+def jsonBaseName(fileName):
+    for extension in JsonWriter.extensions.values():
+        if fileName.endswith(extension):
+            return fileName[:-len(extension)]
+    return fileName
+
+def isJsonFile(fileName):
+    return jsonBaseName(fileName) != fileName
+
+# the existing file of the export named fileName, in any of the formats JsonWriter
+# writes, or None if there's none
+def findJsonFile(fileName):
+    baseName = jsonBaseName(fileName)
+    for extension in JsonWriter.extensions.values():
+        if os.path.exists(baseName + extension):
+            return baseName + extension
+    return None
+
+# reads a JSON file of the export, whichever JsonWriter wrote it
+def readJsonFile(fileName):
+    with open(fileName, 'rb') as inFile:
+        if fileName.endswith('.gz'):
+            with gzip.GzipFile(fileobj=inFile) as reader:
+                return json.load(reader)
+        if fileName.endswith('.zst'):
+            if zstandard is None:
+                raise ValueError("reading %s requires zstandard (pip install zstandard)" % fileName)
+            with zstandard.ZstdDecompressor().stream_reader(inFile) as reader:
+                return json.load(reader)
+        return json.load(inFile)
+
+# Follows Slack's cursor-based pagination (response_metadata.next_cursor)
+# for a single listing.
+#
+# fetchPage is called with the cursor of the page to fetch (None for the first
+# page) and must return the response body. Iterating over the paginator yields
+# the list stored under itemsKey for every page, so callers never have to look
+# at what they already collected to work out where the next page starts.
+#
+# Once a page was handled, cursor is that of the next page (or complete is
+# set if there's none), and a listing can be resumed from it later by passing
+# it as cursor.
+#
+# With stream, fetchPage returns the Response itself, and every page is an
+# iterator decoding its items one at a time (see Response.iter_items), which
+# has to be read before the next page is fetched.
+class Paginator(object):
+    def __init__(self, fetchPage, itemsKey, progressChar=None, itemName='messages', cursor=None,
+                 stream=False):
+        self.fetchPage = fetchPage
+        self.itemsKey = itemsKey
+        self.progressChar = progressChar
+        self.itemName = itemName
+        self.cursor = cursor
+        self.stream = stream
+        self.complete = False
+        self.pages = 0
+        self.items = 0
+        self.elapsed = 0.0
+
+    def _count(self, items, start):
+        self.pages += 1
+        self.items += items
+        self.elapsed = time.monotonic() - start
+
+    def _record(self, body, start):
+        items = body.get(self.itemsKey, [])
+        self._count(len(items), start)
+        return items
+
+    # the rest of the body (and so the next cursor) is only known once the items are read
+    def _streamPage(self, response, start):
+        items = 0
+        for item in response.iter_items(self.itemsKey):
+            items += 1
+            yield item
+        self._count(items, start)
+        self.complete = not self._advance(response.body)
+
+    # moves on to the page after body, returns False if there is none
+    def _advance(self, body):
+        nextCursor = (body.get('response_metadata') or {}).get('next_cursor')
+        if not nextCursor:
+            return False
+        if nextCursor == self.cursor:
+            print("warning: cursor is not changing, stopping pagination")
+            return False
+        self.cursor = nextCursor
+
+        if self.progressChar:
+            sys.stdout.write(self.progressChar)
             sys.stdout.flush()
-            sleep(1.3)  # Respect the Slack API rate limit
-                
-            lastTimestamp = messages[-1]['ts']  # -1 means last element in a list
-            minTimestamp = None
-                
-            if lastTimestamp == lastTimestampFromPreviousIteration:
-                # Then we might be in an infinite loop,
-                # because lastTimestamp is supposed to be decreasing.
-                # Try harder: maybe we want messages[-2]['ts']?
-                    
-                minTimestamp = float(lastTimestamp)
-                for m in messages:
-                    if minTimestamp > float(m['ts']):
-                        minTimestamp = float(m['ts'])
-                
-                if minTimestamp == lastTimestamp:
-                    print("warning: lastTimestamp is not changing.  infinite loop?")
-                lastTimestamp = minTimestamp
-                    
-            lastTimestampFromPreviousIteration = lastTimestamp
+        return True
+
+    def __iter__(self):
+        start = time.monotonic()
+        while not self.complete:
+            if self.stream:
+                page = self._streamPage(self.fetchPage(self.cursor), start)
+                yield page
+                # whatever the caller didn't read
+                deque(page, maxlen=0)
+                continue
+            body = self.fetchPage(self.cursor)
+            items = self._record(body, start)
+            self.complete = not self._advance(body)
+            yield items
+
+    # same, for a fetchPage returning a coroutine (e.g. through AsyncSlacker)
+    async def __aiter__(self):
+        start = time.monotonic()
+        while not self.complete:
+            if self.stream:
+                page = self._streamPage(await self.fetchPage(self.cursor), start)
+                yield page
+                deque(page, maxlen=0)
+                continue
+            body = await self.fetchPage(self.cursor)
+            items = self._record(body, start)
+            self.complete = not self._advance(body)
+            yield items
+
+    def rates(self):
+        # pages per second, items per second
+        if self.elapsed <= 0:
+            return 0.0, 0.0
+        return self.pages / self.elapsed, self.items / self.elapsed
+
+    def summary(self):
+        pagesPerSecond, itemsPerSecond = self.rates()
+        return "{0} {5} in {1} page{2} ({3:.2f} pages/s, {4:.1f} {5}/s)".format(
+            self.items, self.pages, "s" if self.pages != 1 else "", pagesPerSecond, itemsPerSecond,
+            self.itemName)
+
+
+# Same as Paginator, for methods paging by number (paging.page out of
+# paging.pages) instead of by cursor, like files.list. fetchPage is called
+# with the number of the page to fetch, starting at 1.
+class PageNumberPaginator(Paginator):
+    def __init__(self, *args, **kwargs):
+        super(PageNumberPaginator, self).__init__(*args, **kwargs)
+        self.cursor = self.cursor or 1
 
-        else:
-            break
+    def _advance(self, body):
+        paging = body.get('paging') or {}
+        if self.cursor >= paging.get('pages', 0):
+            return False
+        self.cursor += 1
 
-    if lastTimestamp != None:
-        print("")
+        if self.progressChar:
+            sys.stdout.write(self.progressChar)
+            sys.stdout.flush()
+        return True
 
-    messages.sort(key=lambda message: message["ts"])
+
+# Sorts messages by 'ts' within a bounded amount of memory.
+#
+# Messages are buffered serialized; once they take up more than memoryBudget
+# bytes the buffer is sorted and spilled to a temporary file as one run.
+# Iterating over the spool k-way merges the runs (and what is left in memory)
+# back into a single stream of messages in ts order.
+class MessageSpool(object):
+    def __init__(self, memoryBudget):
+        self.memoryBudget = memoryBudget
+        self.buffer = []
+        self.bufferSize = 0
+        self.runs = []
+
+    # returns the message, serialized
+    def add(self, message):
+        line = json.dumps(message)
+        self.buffer.append((message['ts'], line))
+        self.bufferSize += len(line)
+        if self.bufferSize >= self.memoryBudget:
+            self.spill()
+        return line
+
+    def extend(self, messages):
+        for message in messages:
+            self.add(message)
+
+    def spill(self):
+        self.buffer.sort(key=lambda entry: entry[0])
+        run = tempfile.TemporaryFile('w+', encoding='utf-8', prefix='slack_export-')
+        for timeStamp, line in self.buffer:
+            run.write(timeStamp + '\t' + line + '\n')
+        run.seek(0)
+        self.runs.append(run)
+        self.buffer = []
+        self.bufferSize = 0
+
+    def _readRun(self, run):
+        for row in run:
+            timeStamp, line = row.split('\t', 1)
+            yield timeStamp, line
+
+    def __iter__(self):
+        self.buffer.sort(key=lambda entry: entry[0])
+        sortedRuns = [self._readRun(run) for run in self.runs] + [self.buffer]
+        try:
+            for timeStamp, line in heapq.merge(*sortedRuns, key=lambda entry: entry[0]):
+                yield json.loads(line)
+        finally:
+            for run in self.runs:
+                run.close()
+
+
+class HistoryCheckpoint(object):
+    """
+    Progress of getHistory for one conversation, kept in directory so that an export that
+    died halfway through can be resumed (--resume) without fetching the same pages again.
+    Without a directory, nothing is kept.
+
+    Messages (thread replies included) are appended to a log as they are fetched. After every
+    page, the state records the cursor of the next page, the threads whose replies aren't in
+    the log yet and the length of the log at that point. The state is replaced atomically,
+    and whatever the log holds past that length is dropped when resuming, so the two always
+    agree.
+    """
+    chunkSize = 1000
+
+    def __init__(self, directory=None, resume=False):
+        self.directory = directory
+        self.cursor = None
+        self.pendingThreads = []
+        self.complete = False
+        self.log = None
+        if directory is None:
+            return
+
+        self.statePath = os.path.join(directory, 'state')
+        self.logPath = os.path.join(directory, 'messages.jsonl')
+        if not resume and os.path.isdir(directory):
+            shutil.rmtree(directory)
+        mkdir(directory)
+
+        logSize = 0
+        if os.path.exists(self.statePath):
+            with open(self.statePath) as inFile:
+                state = json.load(inFile)
+            self.cursor = state['cursor']
+            self.pendingThreads = state['pendingThreads']
+            self.complete = state['complete']
+            logSize = state['logSize']
+        self.log = open(self.logPath, 'ab')
+        self.log.truncate(logSize)
+        self.log.seek(logSize)
+
+    # the messages logged by the run being resumed, a chunk at a time
+    def messages(self):
+        if self.log is None or self.log.tell() == 0:
+            return
+        chunk = []
+        with open(self.logPath, 'rb') as inFile:
+            for line in inFile:
+                chunk.append(json.loads(line))
+                if len(chunk) == self.chunkSize:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    # line is a message serialized by MessageSpool
+    def append(self, line):
+        if self.log is not None:
+            self.log.write(line.encode('utf-8') + b'\n')
+
+    # complete is set once the last page of history was fetched
+    def save(self, cursor, pendingThreads, complete):
+        if self.log is None:
+            return
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        state = {
+            'cursor': cursor,
+            'pendingThreads': pendingThreads,
+            'complete': complete,
+            'logSize': self.log.tell(),
+        }
+        tmpPath = self.statePath + '.tmp'
+        with open(tmpPath, 'w') as outFile:
+            json.dump(state, outFile)
+        os.replace(tmpPath, self.statePath)
+
+    # once the conversation is written out
+    def remove(self):
+        if self.log is None:
+            return
+        self.log.close()
+        self.log = None
+        shutil.rmtree(self.directory)
+
+
+# Obtains all replies for a given channel id + a starting timestamp (only those
+# newer than oldest, if given)
+def getReplies(channelId, timestamp, pageSize=1000, oldest=0, includeParent=False):
+    conversationObject = slack.conversations
+    pages = Paginator(
+        lambda cursor: conversationObject.replies(
+            channel=channelId,
+            ts=timestamp,
+            cursor=cursor,
+            oldest=oldest,
+            limit=pageSize,
+        ).body,
+        'messages',
+        progressChar='.')
 
     # Obtaining replies also gives us the first message in the the thread
-    # (which we don't want) -- after sorting, our first message with the be the
-    # first in the list of all messages, so we remove the head of the list
-    assert messages[0]["ts"] == timestamp, "unexpected start of thread"
-    messages = messages[1:]
+    # (which we don't want, unless includeParent), so it is dropped from every page
+    messages = []
+    for page in pages:
+        messages.extend(message for message in page if includeParent or message['ts'] != timestamp)
+
+    if pages.pages > 1:
+        print("")
+
+    messages.sort(key=lambda message: message["ts"])
 
     return messages
 
 
 
 
-# fetches the complete message history for a channel/group/im
+# fetches the complete message history for a channel/group/im, returning an
+# iterator over its messages (thread replies included) in ts order
 #
-# pageableObject could be:
-# slack.channel
-# slack.groups
-# slack.im
+# pageableObject is slack.conversations (the legacy channels/groups/im
+# history methods don't support cursors).
 #
 # channelId is the id of the channel/group/im you want to download history for.
+#
+# oldest is the timestamp after which messages are fetched (0 for all of them).
+#
+# memoryBudget is the number of bytes of messages held in memory before they
+# are spilled to disk.
+#
+# checkpoint is a HistoryCheckpoint the progress is saved to after every page,
+# and picked up from when it belongs to an export being resumed.
+
+def getHistory(pageableObject, channelId, pageSize = 1000, oldest = 0,
+               memoryBudget = DEFAULT_MEMORY_BUDGET, checkpoint = None):
+    checkpoint = checkpoint or HistoryCheckpoint()
+    messages = MessageSpool(memoryBudget)
+    # pages are decoded a message at a time, straight into the spool
+    pages = Paginator(
+        lambda cursor: pageableObject.history(
+            channel=channelId,
+            cursor=cursor,
+            oldest=oldest,
+            limit=pageSize
+        ),
+        'messages',
+        progressChar='*',
+        cursor=checkpoint.cursor,
+        stream=True)
+
+    def spool(newMessages):
+        for message in newMessages:
+            checkpoint.append(messages.add(message))
+
+    # Grab all replies -- the threads of a page are fetched by the reply
+    # workers while the next page is being requested
+    def fetchReplies(page):
+        for message in page:
+            if "thread_ts" in message:
+                replies.append((message["thread_ts"],
+                                replyPool.submit(getReplies, channelId, message["thread_ts"], pageSize)))
+            yield message
+
+    # what was fetched before the export being resumed stopped
+    for chunk in checkpoint.messages():
+        messages.extend(chunk)
+    replies = deque((threadTs, replyPool.submit(getReplies, channelId, threadTs, pageSize))
+                    for threadTs in checkpoint.pendingThreads)
+
+    if not checkpoint.complete:
+        for page in pages:
+            spool(fetchReplies(page))
+
+            # Spool the threads that are already done, in submission order, so
+            # the merge doesn't depend on which worker finished first
+            while replies and replies[0][1].done():
+                spool(replies.popleft()[1].result())
+
+            checkpoint.save(pages.cursor, [threadTs for threadTs, future in replies], pages.complete)
+
+    while replies:
+        spool(replies.popleft()[1].result())
+        checkpoint.save(pages.cursor, [threadTs for threadTs, future in replies], True)
+
+    if pages.pages > 1:
+        print("")
+    print("Fetched {0} from {1}".format(pages.summary(), channelId))
+
+    return iter(messages)
+
+
+# Same as getReplies, on the event loop of the --asyncTransport client
+async def asyncGetReplies(channelId, timestamp, pageSize=1000, oldest=0, includeParent=False):
+    async def fetchPage(cursor):
+        return (await asyncSlack.conversations.replies(
+            channel=channelId,
+            ts=timestamp,
+            cursor=cursor,
+            oldest=oldest,
+            limit=pageSize,
+        )).body
+    pages = Paginator(fetchPage, 'messages', progressChar='.')
 
-def getHistory(pageableObject, channelId, pageSize = 1000):
     messages = []
-    lastTimestamp = None
-    lastTimestampFromPreviousIteration = lastTimestamp
+    async for page in pages:
+        messages.extend(message for message in page if includeParent or message['ts'] != timestamp)
 
-    while(True):
-        try:
-             if isinstance(pageableObject, Conversations):
-                response = pageableObject.history(
-                    channel=channelId,
-                    latest=lastTimestamp,
-                    oldest=0,
-                    limit=pageSize
-                ).body
-             else:
-                response = pageableObject.history(
-                    channel = channelId,
-                    latest    = lastTimestamp,
-                    oldest    = 0,
-                    count     = pageSize
-                ).body
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 429:
-                retryInSeconds = int(e.response.headers['Retry-After'])
-                print("Rate limit hit. Retrying in {0} second{1}.".format(retryInSeconds, "s" if retryInSeconds > 1 else ""))
-                sleep(retryInSeconds + 1)
-                if isinstance(pageableObject, Conversations):
-                    response = pageableObject.history(
-                        channel=channelId,
-                        latest=lastTimestamp,
-                        oldest=0,
-                        limit=pageSize
-                    ).body
-                else:
-                    response = pageableObject.history(
-                        channel=channelId,
-                        latest=lastTimestamp,
-                        oldest=0,
-                        count=pageSize
-                    ).body
+    messages.sort(key=lambda message: message["ts"])
 
-        messages.extend(response['messages'])
+    return messages
 
-        # Grab all replies
-        for message in response["messages"]:
-            if "thread_ts" in message:
-                sleep(0.5) #INSERT LIMIT 
-                messages.extend(getReplies(channelId, message["thread_ts"], pageSize))
 
-        if (response['has_more'] == True):
-            sys.stdout.write("*")
-            sys.stdout.flush()
-            sleep(1.3) # Respect the Slack API rate limit
-                
-            lastTimestamp = messages[-1]['ts'] # -1 means last element in a list
-            minTimestamp = None
-                
-            if lastTimestamp == lastTimestampFromPreviousIteration:
-                # Then we might be in an infinite loop,
-                # because lastTimestamp is supposed to be decreasing.
-                # Try harder: maybe we want messages[-2]['ts']?
-                    
-                minTimestamp = float(lastTimestamp)
-                for m in messages:
-                    if minTimestamp > float(m['ts']):
-                        minTimestamp = float(m['ts'])
-                
-                if minTimestamp == lastTimestamp:
-                    print("warning: lastTimestamp is not changing.  infinite loop?")
-                lastTimestamp = minTimestamp
-                    
-            lastTimestampFromPreviousIteration = lastTimestamp
+# Same as getHistory, on the event loop of the --asyncTransport client: every
+# thread of a page is requested at once, bounded only by the rate limiter and
+# the connection pool.
+async def asyncGetHistory(channelId, pageSize = 1000, oldest = 0,
+                          memoryBudget = DEFAULT_MEMORY_BUDGET, checkpoint = None):
+    async def fetchPage(cursor):
+        return await asyncSlack.conversations.history(
+            channel=channelId,
+            cursor=cursor,
+            oldest=oldest,
+            limit=pageSize
+        )
+    checkpoint = checkpoint or HistoryCheckpoint()
+    messages = MessageSpool(memoryBudget)
+    pages = Paginator(fetchPage, 'messages', progressChar='*', cursor=checkpoint.cursor, stream=True)
+    loop = asyncio.get_running_loop()
 
-        else:
-            break
+    # the spool and the checkpoint write to disk (the checkpoint syncing it), which
+    # runs on the loop's default executor so requests go on meanwhile
+    def offLoop(function, *args):
+        return loop.run_in_executor(None, function, *args)
+
+    def spool(newMessages):
+        for message in newMessages:
+            checkpoint.append(messages.add(message))
 
-    if lastTimestamp != None:
+    def restore():
+        for chunk in checkpoint.messages():
+            messages.extend(chunk)
+
+    def fetchThread(threadTs):
+        return threadTs, asyncio.ensure_future(asyncGetReplies(channelId, threadTs, pageSize))
+
+    def fetchReplies(page):
+        for message in page:
+            if "thread_ts" in message:
+                replies.append(fetchThread(message["thread_ts"]))
+            yield message
+
+    await offLoop(restore)
+    replies = deque(fetchThread(threadTs) for threadTs in checkpoint.pendingThreads)
+    try:
+        if not checkpoint.complete:
+            async for page in pages:
+                await offLoop(spool, list(fetchReplies(page)))
+
+                while replies and replies[0][1].done():
+                    await offLoop(spool, replies.popleft()[1].result())
+
+                await offLoop(checkpoint.save, pages.cursor, [threadTs for threadTs, task in replies],
+                              pages.complete)
+
+        while replies:
+            await offLoop(spool, await replies[0][1])
+            replies.popleft()
+            await offLoop(checkpoint.save, pages.cursor, [threadTs for threadTs, task in replies], True)
+    except BaseException:
+        for threadTs, task in replies:
+            task.cancel()
+        raise
+
+    if pages.pages > 1:
         print("")
+    print("Fetched {0} from {1}".format(pages.summary(), channelId))
 
-    messages.sort(key = lambda message: message['ts'])
+    return iter(messages)
 
-    return messages
+
+# Runs a coroutine on the --asyncTransport event loop and waits for its result
+def runOnLoop(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, asyncLoop).result()
 
 
 def mkdir(directory):
     if not os.path.isdir(directory):
-        os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)
 
 
 # create datetime object from slack timestamp ('ts') string
@@ -1459,15 +2622,12 @@ def parseTimeStamp( timeStamp ):
             return datetime.utcfromtimestamp( float(t_list[0]) )
 
 
-# move channel files from old directory to one with new channel name
-def channelRename( oldRoomName, newRoomName ):
-    # check if any files need to be moved
-    if not os.path.isdir( oldRoomName ):
-        return
-    mkdir( newRoomName )
-    for fileName in os.listdir( oldRoomName ):
-        shutil.move( os.path.join( oldRoomName, fileName ), newRoomName )
-    os.rmdir( oldRoomName )
+# merge messages into the ones already in a day file, newer copies of a
+# message (same 'ts') replacing older ones
+def mergeMessages( existingMessages, messages ):
+    messagesByTimeStamp = { message['ts']: message for message in existingMessages }
+    messagesByTimeStamp.update( (message['ts'], message) for message in messages )
+    return sorted( messagesByTimeStamp.values(), key = lambda message: message['ts'] )
 
 
 def writeMessageFile( fileName, messages ):
@@ -1480,14 +2640,32 @@ def writeMessageFile( fileName, messages ):
     if not os.path.isdir( directory ):
         mkdir( directory )
 
-    with open(fileName, 'w') as outFile:
-        json.dump( messages, outFile, indent=4)
+    # users.json lists the authors of the messages
+    messageAuthors.update( message['user'] for message in messages if 'user' in message )
 
+    # an incremental export adds to the day files of the previous one
+    existingFile = findJsonFile( fileName )
+    if existingFile:
+        messages = mergeMessages( readJsonFile( existingFile ), messages )
 
-# parse messages by date
-def parseMessages( roomDir, messages, roomType ):
-    nameChangeFlag = roomType + "_name"
+    # with --downloadSlackFiles, links are replaced (and downloads queued) before the day
+    # file is written, rather than in a second pass over the export
+    if fileDownloader:
+        for message in messages:
+            localizeFiles( message )
+
+    fileName = jsonWriter.write( fileName, messages )
+
+    # day files streamed to the zip aren't looked at again
+    if fileDownloader and not zipExport:
+        fileManifest.markProcessed( fileName )
 
+
+# parse messages by date
+# roomDir is the conversation's final directory (see planDirectories):
+# channel_name and group_name events are written along with the other messages
+# rather than moving the day files already written
+def parseMessages( roomDir, messages ):
     currentFileDate = ''
     currentMessages = []
     for message in messages:
@@ -1502,20 +2680,274 @@ def parseMessages( roomDir, messages, roomType ):
             currentFileDate = fileDate
             currentMessages = []
 
-        # check if current message is a name change
-        # dms won't have name change events
-        if roomType != "im" and ( 'subtype' in message ) and message['subtype'] == nameChangeFlag:
-            roomDir = message['name']
-            oldRoomPath = message['old_name']
-            newRoomPath = roomDir
-            channelRename( oldRoomPath, newRoomPath )
-
         currentMessages.append( message )
     outFileName = '{room}/{file}.json'.format( room = roomDir, file = currentFileDate )
     writeMessageFile( outFileName, currentMessages )
 
-def filterConversationsByName(channelsOrGroups, channelOrGroupNames):
-    return [conversation for conversation in channelsOrGroups if conversation['name'] in channelOrGroupNames]
+# thread replies only come from conversations.replies, never from the
+# conversation's history (unless also sent to the channel)
+def isThreadReply(message):
+    return ('thread_ts' in message and message['thread_ts'] != message['ts']
+            and message.get('subtype') != 'thread_broadcast')
+
+# Remembers the newest message exported from each conversation, so that the
+# next incremental export only asks Slack for what came after it, the thread
+# parents exported with the ts of their latest reply, whose new replies it asks
+# for separately (see fetchThreadUpdates), the directory it was exported to, the conversations the current run is done with, which
+# --resume skips, and the options of the run (see RESUMED_OPTIONS).
+# Stored as JSON in the export directory (not as a .json file, which would
+# be mistaken for a day file).
+class ExportState(object):
+    fileName = '.export_state'
+
+    def __init__(self, directory, resume=False):
+        self.path = os.path.join(directory, self.fileName)
+        self.highWaterMarks = {}
+        self.threads = {}
+        self.directories = {}
+        self.options = {}
+        self.completed = set()
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as inFile:
+                state = json.load(inFile)
+            self.highWaterMarks = state.get('highWaterMarks', {})
+            self.threads = state.get('threads', {})
+            self.directories = state.get('directories', {})
+            self.options = state.get('options', {})
+            # a new run starts over
+            if resume:
+                self.completed = set(state.get('completed', []))
+
+    def highWaterMark(self, conversationId):
+        return self.highWaterMarks.get(conversationId, 0)
+
+    def setHighWaterMark(self, conversationId, timeStamp):
+        with self.lock:
+            if timeStamp > self.highWaterMarks.get(conversationId, ''):
+                self.highWaterMarks[conversationId] = timeStamp
+            self.save()
+
+    # the latest_reply of the conversation's threads by parent ts
+    def threadReplies(self, conversationId):
+        return self.threads.get(conversationId, {})
+
+    # records the latest_reply of the given threads, forgetting those started
+    # before since, which aren't checked for new replies any more
+    def setThreadReplies(self, conversationId, threads, since):
+        with self.lock:
+            threads = dict(self.threads.get(conversationId, {}), **threads)
+            threads = {threadTs: latestReply for threadTs, latestReply in threads.items()
+                       if float(threadTs) >= since}
+            if threads:
+                self.threads[conversationId] = threads
+            else:
+                self.threads.pop(conversationId, None)
+            self.save()
+
+    def directory(self, conversationId):
+        return self.directories.get(conversationId)
+
+    def setDirectories(self, directories):
+        with self.lock:
+            self.directories.update(directories)
+            self.save()
+
+    def setOptions(self, options):
+        with self.lock:
+            self.options = options
+            self.save()
+
+    def isCompleted(self, conversationId):
+        return conversationId in self.completed
+
+    def setCompleted(self, conversationId):
+        with self.lock:
+            self.completed.add(conversationId)
+            self.save()
+
+    def save(self):
+        # write to a temporary file first so a crash can't leave a truncated state
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as outFile:
+            json.dump({'highWaterMarks': self.highWaterMarks, 'threads': self.threads,
+                       'directories': self.directories,
+                       'options': self.options, 'completed': sorted(self.completed)},
+                      outFile, indent=4)
+        os.replace(tmpPath, self.path)
+
+# passes messages (in ts order) through, keeping the ts of the newest one that
+# isn't a thread reply in newest['ts'], and the latest_reply of the thread
+# parents in threads
+def trackNewest(messages, newest, threads):
+    for message in messages:
+        if not isThreadReply(message):
+            newest['ts'] = message['ts']
+        if message.get('thread_ts') == message['ts']:
+            threads[message['ts']] = message.get('latest_reply', message['ts'])
+        yield message
+
+# With --incremental, conversations.history is only asked for the messages newer than
+# the high-water mark, which leaves out the replies posted since the previous export to
+# its threads. The threads recorded in the export state and started within the last
+# --threadLookback days are asked for the replies newer than their recorded latest
+# reply; the parent comes along, with its reply_count and latest_reply up to date, and
+# replaces the exported one. Returns the messages in ts order.
+def fetchThreadUpdates(conversationId, since):
+    threads = [(threadTs, latestReply)
+               for threadTs, latestReply in exportState.threadReplies(conversationId).items()
+               if float(threadTs) >= since]
+    if not threads:
+        return []
+    print("Checking {0} threads for new replies".format(len(threads)))
+    if asyncSlack:
+        async def fetchAll():
+            return await asyncio.gather(*(
+                asyncGetReplies(conversationId, threadTs, oldest=latestReply, includeParent=True)
+                for threadTs, latestReply in threads))
+        results = runOnLoop(fetchAll())
+    else:
+        results = replyPool.map(
+            lambda thread: getReplies(conversationId, thread[0], oldest=thread[1], includeParent=True),
+            threads)
+    return sorted((message for replies in results for message in replies),
+                  key=lambda message: message['ts'])
+
+# fetch the history of a conversation newer than what the export already has,
+# write it out by date and remember the newest message for the next run
+def exportHistory(conversationId, roomDir):
+    if exportState.isCompleted(conversationId):
+        print("Already exported {0}, skipping".format(roomDir))
+        return
+
+    checkpoint = HistoryCheckpoint()
+    if checkpointDirectory:
+        checkpoint = HistoryCheckpoint(os.path.join(checkpointDirectory, conversationId),
+                                       resume=bool(args.resume))
+    oldest = exportState.highWaterMark(conversationId)
+    memoryBudget = args.memoryBudget * 1024 * 1024
+    if asyncSlack:
+        messages = runOnLoop(asyncGetHistory(conversationId, oldest=oldest,
+                                             memoryBudget=memoryBudget, checkpoint=checkpoint))
+    else:
+        messages = getHistory(slack.conversations, conversationId,
+                              oldest=oldest, memoryBudget=memoryBudget, checkpoint=checkpoint)
+    since = time.time() - args.threadLookback * 24 * 60 * 60
+    if oldest:
+        messages = heapq.merge(messages, fetchThreadUpdates(conversationId, since),
+                               key=lambda message: message['ts'])
+    newest, threads = {}, {}
+    parseMessages( roomDir, trackNewest(messages, newest, threads) )
+    exportState.setThreadReplies(conversationId, threads, since)
+    if newest:
+        exportState.setHighWaterMark(conversationId, newest['ts'])
+    exportState.setCompleted(conversationId)
+    checkpoint.remove()
+
+# Decides, before any conversation is exported, the directory the day files of each
+# channel and group are written to: its current name, as the history can hold
+# channel_name / group_name events but the listed name is the one they end at, so that
+# every day file is written once, to its final path. Runs on the main thread, and
+# returns the directories by conversation ID.
+#
+# The export state records which conversation each directory belongs to: a directory
+# still belonging to another conversation (e.g. a channel renamed since, whose old name
+# was then given to this one) isn't taken over, the conversation being exported to
+# <name>-<id> instead. The files of a conversation exported under another name by a
+# previous (incremental) export are moved to its new directory.
+def planDirectories(conversations):
+    wantedDirs = {}
+    for conversation in conversations:
+        roomDir = conversation['name']
+        try:
+            mkdir( roomDir )
+        except NotADirectoryError:
+            # Failed creating directory, probably because the name is not a valid
+            # Windows directory name (like "com4"). Adding a prefix to try to work-around
+            # that.
+            roomDir = ("c-" + conversation['name'])
+            mkdir( roomDir )
+        wantedDirs[conversation['id']] = roomDir
+
+    # the recorded directories whose conversations aren't moving out of them in this run
+    owners = {directory: conversationId for conversationId, directory in exportState.directories.items()
+              if wantedDirs.get(conversationId, directory) == directory}
+    roomDirs = {}
+    for conversation in conversations:
+        conversationId = conversation['id']
+        roomDir = wantedDirs[conversationId]
+        if owners.get(roomDir, conversationId) != conversationId:
+            roomDir = "{0}-{1}".format(roomDir, conversationId)
+            print("{0} belongs to another conversation of the export, exporting {1} to {2}".format(
+                wantedDirs[conversationId], conversation['name'], roomDir))
+            mkdir( roomDir )
+        owners[roomDir] = conversationId
+        roomDirs[conversationId] = roomDir
+
+    # every directory being vacated is moved aside before files move in, as a
+    # conversation can take the old name of another
+    for conversationId, roomDir in roomDirs.items():
+        previousDir = exportState.directory(conversationId)
+        if previousDir and previousDir != roomDir and os.path.isdir(previousDir):
+            print("{0} was renamed {1} since the previous export, moving its files".format(previousDir, roomDir))
+            mkdir( RENAMES_DIRECTORY )
+            os.rename( previousDir, os.path.join(RENAMES_DIRECTORY, conversationId) )
+    for conversationId, roomDir in roomDirs.items():
+        # it may have been one of the directories moved aside
+        mkdir( roomDir )
+        # also picks up the files of a move that was interrupted
+        movedDir = os.path.join(RENAMES_DIRECTORY, conversationId)
+        if os.path.isdir(movedDir):
+            moveDayFiles(movedDir, roomDir)
+    exportState.setDirectories(roomDirs)
+    if os.path.isdir(RENAMES_DIRECTORY) and not os.listdir(RENAMES_DIRECTORY):
+        os.rmdir(RENAMES_DIRECTORY)
+    return roomDirs
+
+# moves the day files of sourceDir to targetDir, merging those of the days targetDir
+# already has a file for
+def moveDayFiles(sourceDir, targetDir):
+    for fileName in os.listdir(sourceDir):
+        sourceFile = os.path.join(sourceDir, fileName)
+        targetFile = os.path.join(targetDir, fileName)
+        existingFile = findJsonFile(targetFile) if isJsonFile(fileName) else None
+        if existingFile:
+            jsonWriter.write(targetFile, mergeMessages(readJsonFile(existingFile), readJsonFile(sourceFile)))
+            os.remove(sourceFile)
+        elif not os.path.exists(targetFile):
+            os.rename(sourceFile, targetFile)
+    if not os.listdir(sourceDir):
+        os.rmdir(sourceDir)
+
+# Queues conversations for export on the --conversationWorkers threads, which
+# share the API rate limits. Public channels, groups and DMs all go to the
+# same pool, and each conversation writes to its own directory.
+def scheduleExports(conversations, exportConversation, conversationName):
+    for conversation in conversations:
+        future = conversationPool.submit(exportConversation, conversation)
+        scheduledExports[future] = conversationName(conversation)
+
+# Waits for the scheduled exports to finish. A conversation that failed is
+# reported without stopping the others; returns the names of those that failed.
+def waitForExports():
+    failures = []
+    for future in as_completed(scheduledExports):
+        try:
+            future.result()
+        except Exception as e:
+            print("Failed exporting {0}: {1!r}".format(scheduledExports[future], e))
+            failures.append(scheduledExports[future])
+
+    if failures:
+        print("Failed exporting {0} of {1} conversations: {2}".format(
+            len(failures), len(scheduledExports), ", ".join(failures)))
+        if checkpointDirectory:
+            print("Run again with --resume {0} to continue where they stopped".format(outputDirectory))
+    scheduledExports.clear()
+    return failures
+
+def filterConversationsByName(kind, channelOrGroupNames):
+    return workspace.findConversations(kind, channelOrGroupNames)
 
 def promptForPublicChannels(channels):
     channelNames = [channel['name'] for channel in channels]
@@ -1532,22 +2964,14 @@ def fetchPublicChannels(channels):
         print()
         return
 
-    for channel in channels:
-        channelDir = channel['name']
-        print("Fetching history for Public Channel: {0}".format(channelDir))
-        try:
-            mkdir( channelDir )
-        except NotADirectoryError:
-            # Failed creating directory, probably because the name is not a valid
-            # Windows directory name (like "com4"). Adding a prefix to try to work-around
-            # that.
-            channelDir = ("c-" + channel['name'])
-            mkdir( channelDir )
-        messages = getHistory(slack.conversations, channel['id'])
-        parseMessages( channelDir, messages, 'channel')
+    def fetchPublicChannel(channel):
+        print("Fetching history for Public Channel: {0}".format(channel['name']))
+        exportHistory(channel['id'], conversationDirectories[channel['id']])
+
+    scheduleExports(channels, fetchPublicChannel, lambda channel: channel['name'])
 
 # write channels.json file
-def dumpChannelFile():
+def dumpChannelFile(channels, groups, dms):
     print("Making channels file")
 
     private = []
@@ -1564,21 +2988,33 @@ def dumpChannelFile():
         dm['members'] = [dm['user'], tokenOwnerId]
 
     #We will be overwriting this file on each run.
-    with open('channels.json', 'w') as outFile:
-        json.dump( channels , outFile, indent=4)
-    with open('groups.json', 'w') as outFile:
-        json.dump( private , outFile, indent=4)
-    with open('mpims.json', 'w') as outFile:
-        json.dump( mpim , outFile, indent=4)
-    with open('dms.json', 'w') as outFile:
-        json.dump( dms , outFile, indent=4)
-
-def filterDirectMessagesByUserNameOrId(dms, userNamesOrIds):
-    userIds = [userIdsByName.get(userNameOrId, userNameOrId) for userNameOrId in userNamesOrIds]
-    return [dm for dm in dms if dm['user'] in userIds]
+    writeMetadataFile( 'channels.json', channels )
+    writeMetadataFile( 'groups.json', private )
+    writeMetadataFile( 'mpims.json', mpim )
+    writeMetadataFile( 'dms.json', dms )
+
+# writes the list of conversations or users to fileName. When the export goes into
+# a previous one (--incremental or --resume), whose other conversations are still in
+# the directory, the ones it already lists are kept (items are matched by 'id', those
+# of this run replacing theirs)
+def writeMetadataFile( fileName, items ):
+    existingFile = findJsonFile( fileName ) if args.incremental or args.resume else None
+    if existingFile:
+        itemsById = { item['id']: item for item in readJsonFile( existingFile ) }
+        itemsById.update( (item['id'], item) for item in items )
+        items = list( itemsById.values() )
+    jsonWriter.write( fileName, items )
+
+def filterDirectMessagesByUserNameOrId(kind, userNamesOrIds):
+    # user names can only be resolved by listing every user
+    dmsByUserId = workspace.conversationsByName[kind]
+    if any(userNameOrId not in dmsByUserId for userNameOrId in userNamesOrIds):
+        loadUsers()
+    return workspace.findConversations(kind, userNamesOrIds)
 
 def promptForDirectMessages(dms):
-    dmNames = [userNamesById.get(dm['user'], dm['user'] + " (name unknown)") for dm in dms]
+    loadUsers(dm['user'] for dm in dms)
+    dmNames = [workspace.conversationName(dm) for dm in dms]
     selectedDms = pick(dmNames, 'Select the 1:1 DMs you want to export:', multi_select=True)
     return [dms[index] for dmName, index in selectedDms]
 
@@ -1589,17 +3025,17 @@ def fetchDirectMessages(dms):
     if dryRun:
         print("1:1 DMs selected for export:")
         for dm in dms:
-            print(userNamesById.get(dm['user'], dm['user'] + " (name unknown)"))
+            print(workspace.conversationName(dm))
         print()
         return
 
-    for dm in dms:
-        name = userNamesById.get(dm['user'], dm['user'] + " (name unknown)")
-        print("Fetching 1:1 DMs with {0}".format(name))
+    def fetchDirectMessage(dm):
+        print("Fetching 1:1 DMs with {0}".format(workspace.conversationName(dm)))
         dmId = dm['id']
         mkdir(dmId)
-        messages = getHistory(slack.conversations, dm['id'])
-        parseMessages( dmId, messages, "im" )
+        exportHistory(dm['id'], dmId)
+
+    scheduleExports(dms, fetchDirectMessage, workspace.conversationName)
 
 def promptForGroups(groups):
     groupNames = [group['name'] for group in groups]
@@ -1617,26 +3053,26 @@ def fetchGroups(groups):
         print()
         return
 
-    for group in groups:
-        groupDir = group['name']
-        mkdir(groupDir)
-        messages = []
+    def fetchGroup(group):
         print("Fetching history for Private Channel / Group DM: {0}".format(group['name']))
-        messages = getHistory(slack.conversations, group['id'])
-        parseMessages( groupDir, messages, 'group' )
+        exportHistory(group['id'], conversationDirectories[group['id']])
+
+    scheduleExports(groups, fetchGroup, lambda group: group['name'])
 
-# fetch all users for the channel and return a map userId -> userName
-def getUserMap():
-    global userNamesById, userIdsByName
-    for user in users:
-        userNamesById[user['id']] = user['name']
-        userIdsByName[user['name']] = user['id']
+# the users the viewer needs: the token owner, the members of the exported
+# conversations and the authors of their messages
+def exportedUserIds(conversations):
+    userIds = {tokenOwnerId} | messageAuthors
+    for conversation in conversations:
+        userIds.update(conversation.get('members', []))
+        if 'user' in conversation:
+            userIds.add(conversation['user'])
+    return userIds
 
 # stores json of user info
 def dumpUserFile():
     #write to user file, any existing file needs to be overwritten.
-    with open( "users.json", 'w') as userFile:
-        json.dump( users, userFile, indent=4 )
+    writeMetadataFile( "users.json", workspace.users )
 
 # get basic info about the slack channel to ensure the authentication token works
 def doTestAuth():
@@ -1646,150 +3082,757 @@ def doTestAuth():
     print("Successfully authenticated for team {0} and user {1} ".format(teamName, currentUser))
     return testAuth
 
+class MetadataCache(object):
+    """
+    Workspace metadata (conversation lists, members and users) kept between runs, in an SQLite
+    database per team, so that repeated exports of the same workspace don't list it again.
+
+    get returns the value stored under a key less than ttl seconds ago, or fetches, stores and
+    returns it. With refresh, every value is fetched again (and stored). Without a directory,
+    nothing is stored at all.
+    """
+    commitEvery = 1000
+
+    def __init__(self, directory=None, teamId=None, ttl=0, refresh=False):
+        self.ttl = ttl
+        self.refresh = refresh
+        self.connection = None
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        if directory is None:
+            return
+
+        mkdir(directory)
+        self.connection = sqlite3.connect(os.path.join(directory, teamId + '.sqlite'),
+                                          check_same_thread=False)
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT, fetched REAL)")
+            self.connection.commit()
+
+    def get(self, key, fetch):
+        if self.connection is None:
+            return fetch()
+
+        if not self.refresh:
+            with self.lock:
+                row = self.connection.execute("SELECT value, fetched FROM entries WHERE key = ?",
+                                              (key,)).fetchone()
+            if row and time.time() - row[1] < self.ttl:
+                return json.loads(row[0])
+
+        value = fetch()
+        # failed lookups aren't remembered
+        if value is not None:
+            with self.lock:
+                self.connection.execute("INSERT OR REPLACE INTO entries (key, value, fetched) VALUES (?, ?, ?)",
+                                        (key, json.dumps(value), time.time()))
+                self.uncommitted += 1
+                if self.uncommitted >= self.commitEvery:
+                    self.connection.commit()
+                    self.uncommitted = 0
+        return value
+
+    def close(self):
+        if self.connection is None:
+            return
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+class WorkspaceDirectory(object):
+    """
+    The users and conversations of the workspace known to the export, indexed by ID
+    and by name so that selections, prompts and name lookups don't scan the lists.
+    Conversations are of one of the kinds: channels, groups (private channels and
+    group DMs) and dms (1:1 DMs, which are named by the ID of the other user).
+    """
+
+    kinds = ('channels', 'groups', 'dms')
+
+    def __init__(self):
+        self.users = []
+        self.usersById = {}
+        self.userIdsByName = {}
+        # set once every user of the workspace has been listed
+        self.allUsersLoaded = False
+        self.conversations = {kind: [] for kind in self.kinds}
+        self.conversationsById = {}
+        self.conversationsByName = {kind: {} for kind in self.kinds}
+
+    def addUsers(self, users):
+        for user in users:
+            if user['id'] not in self.usersById:
+                self.users.append(user)
+                self.usersById[user['id']] = user
+            self.userIdsByName[user['name']] = user['id']
+
+    def setConversations(self, kind, conversations):
+        nameKey = 'user' if kind == 'dms' else 'name'
+        self.conversations[kind] = conversations
+        self.conversationsByName[kind] = {conversation[nameKey]: conversation for conversation in conversations}
+        for conversation in conversations:
+            self.conversationsById[conversation['id']] = conversation
+
+    def userName(self, userId):
+        user = self.usersById.get(userId)
+        return user['name'] if user else userId + " (name unknown)"
+
+    def conversationName(self, conversation):
+        if 'user' in conversation:
+            return self.userName(conversation['user'])
+        return conversation['name']
+
+    # the conversations of the kind with the given names (for DMs, user names or
+    # IDs), in the order given, names not found being skipped
+    def findConversations(self, kind, names):
+        byName = self.conversationsByName[kind]
+        found = {}
+        for name in names:
+            if kind == 'dms':
+                name = self.userIdsByName.get(name, name)
+            conversation = byName.get(name)
+            if conversation is not None:
+                found.setdefault(conversation['id'], conversation)
+        return list(found.values())
+
 # Since Slacker does not Cache.. populate some reused lists
-# TODO: 
-#   1. Only populate data for lists that will be used in export.
-#   2. Allow adjustable limits (greater or less than 1000).
-#      Fork by veqryn appears to do this for users:
-#        - users = slack.users.list().body['members']
-#        - print(u"Found {0} Users".format(len(users)))
-#        -  
-#        + users_list = slack.users.list(limit=500)
-#        + users = users_list.body['members']
-#        + while len(users_list.body['members']) >= 500:
-#        +     users_list = slack.users.list(limit=500, cursor=users_list.body['response_metadata']['next_cursor'])
-#        +     users.extend(users_list.body['members'])
-#        +     sleep(1)  # crude rate limit
-#        +        
-#        + print("Found {0} Users".format(len(users)))
-#   
+# Only the kinds of conversations that can be selected are listed; members and
+# users are looked up later, for the conversations actually exported.
 def bootstrapKeyValues():
-    global users, channels, groups, dms
-     
-    users = slack.users.list().body['members']
-    print("Found {0} Users".format(len(users)))
-    sleep(3.05)
-
-    channels = slack.conversations.list(limit = 1000, types=('public_channel')).body['channels']
-    print("Found {0} Public Channels".format(len(channels)))
-    # think mayne need to retrieve channel memberships for the slack-export-viewer to work
-    for n in range(len(channels)):
-        channels[n]["members"] = slack.conversations.members(limit=1000, channel=channels[n]['id']).body['members']
-        print("Retrieved members of {0}".format(channels[n]['name']))
-    sleep(3.05)
-
-    groups = slack.conversations.list(limit = 1000, types=('private_channel', 'mpim')).body['channels']
-    print("Found {0} Private Channels or Group DMs".format(len(groups)))
-    # need to retrieve channel memberships for the slack-export-viewer to work
-    for n in range(len(groups)):
-        groups[n]["members"] = slack.conversations.members(limit=1000, channel=groups[n]['id']).body['members']
-        print("Retrieved members of {0}".format(groups[n]['name']))
-    sleep(3.05)
-
-    dms = slack.conversations.list(limit = 1000, types=('im')).body['channels']
-    print("Found {0} 1:1 DM conversations\n".format(len(dms)))
-    sleep(3.05)
-
-    getUserMap()
-
-# Returns the conversations to download based on the command-line arguments
-def selectConversations(allConversations, commandLineArg, filter, prompt):
+    if isSelectable(args.publicChannels):
+        workspace.setConversations('channels', listConversations('public_channel'))
+        print("Found {0} Public Channels".format(len(workspace.conversations['channels'])))
+
+    if isSelectable(args.groups):
+        workspace.setConversations('groups', listConversations('private_channel', 'mpim'))
+        print("Found {0} Private Channels or Group DMs".format(len(workspace.conversations['groups'])))
+
+    if isSelectable(args.directMessages):
+        workspace.setConversations('dms', listConversations('im'))
+        print("Found {0} 1:1 DM conversations".format(len(workspace.conversations['dms'])))
+    print()
+
+def listConversations(*types):
+    return metadataCache.get('conversations:' + ','.join(types),
+                             lambda: listAll(slack.conversations.list, 'channels', types=types))
+
+# Makes sure the given users (every user if userIds is None) are in the workspace
+# directory, looking them up one at a time with users.info unless listing every
+# user is expected to be quicker.
+def loadUsers(userIds=None):
+    if workspace.allUsersLoaded:
+        return
+    if userIds is not None:
+        userIds = {userId for userId in userIds if userId not in workspace.usersById}
+        if not userIds:
+            return
+
+    if userIds is None or listingUsersIsQuicker(len(userIds)):
+        users = metadataCache.get('users', lambda: listAll(slack.users.list, 'members',
+                                                           pageSize=USERS_PAGE_SIZE))
+        workspace.addUsers(users)
+        workspace.allUsersLoaded = True
+        print("Found {0} Users".format(len(users)))
+    else:
+        workspace.addUsers(user for user in replyPool.map(fetchUser, sorted(userIds)) if user)
+        print("Looked up {0} Users".format(len(userIds)))
+
+# Whether looking up the given number of users with users.info would take longer, at
+# the rate limits of the methods, than listing every user with users.list. The workspace
+# has at least the users already known and those looked up, so listing it takes at
+# least as many pages.
+def listingUsersIsQuicker(lookups):
+    rates = slack.rate_limiter.rates
+    pages = max(1, -(-(len(workspace.usersById) + lookups) // USERS_PAGE_SIZE))
+    return lookups / rates['users.info'] > pages / rates['users.list']
+
+def fetchUser(userId):
+    def userInfo():
+        try:
+            return slack.users.info(userId).body['user']
+        except Error as e:
+            print("Failed looking up user {0}: {1}".format(userId, e))
+            return None
+    return metadataCache.get('user:' + userId, userInfo)
+
+# Collects every item of a cursor-paginated listing (users.list, conversations.list,
+# conversations.members...), listMethod being called with the other arguments
+def listAll(listMethod, itemsKey, pageSize=1000, **kwargs):
+    items = []
+    pages = Paginator(
+        lambda cursor: listMethod(cursor=cursor, limit=pageSize, **kwargs),
+        itemsKey,
+        itemName=itemsKey,
+        stream=True)
+    for page in pages:
+        items.extend(page)
+    return items
+
+# Stores the members of each conversation in its 'members', fetching them
+# concurrently on the reply workers (the rate limiter keeps them within
+# conversations.members' limits)
+def fetchMembers(conversations):
+    def listMembers(conversationId):
+        return metadataCache.get('members:' + conversationId,
+                                 lambda: listAll(slack.conversations.members, 'members', channel=conversationId))
+
+    futures = {replyPool.submit(listMembers, conversation['id']): conversation
+               for conversation in conversations}
+    for future in as_completed(futures):
+        conversation = futures[future]
+        conversation['members'] = future.result()
+        print("Retrieved members of {0}".format(conversation['name']))
+
+# Returns the conversations of the kind (see WorkspaceDirectory) to download based
+# on the command-line arguments
+def selectConversations(kind, commandLineArg, filter, prompt):
     global args
-    if args.excludeArchived:
-        allConversations = [ conv for conv in allConversations if not conv["is_archived"] ]
-    if isinstance(commandLineArg, list) and len(commandLineArg) > 0:
-        return filter(allConversations, commandLineArg)
+    named = isinstance(commandLineArg, list) and len(commandLineArg) > 0
+    if named:
+        conversations = filter(kind, commandLineArg)
     elif commandLineArg != None or not anyConversationsSpecified():
-        if args.prompt:
-            return prompt(allConversations)
-        else:
-            return allConversations
+        conversations = workspace.conversations[kind]
     else:
         return []
+    if args.excludeArchived:
+        conversations = [ conv for conv in conversations if not conv["is_archived"] ]
+    if args.prompt and not named:
+        return prompt(conversations)
+    return conversations
+
+# Returns true if conversations of the kind given by commandLineArg can be selected
+def isSelectable(commandLineArg):
+    return commandLineArg != None or not anyConversationsSpecified()
 
 # Returns true if any conversations were specified on the command line
 def anyConversationsSpecified():
     global args
     return args.publicChannels != None or args.groups != None or args.directMessages != None
 
+def exportOptions():
+    return {name: getattr(args, name) for name in RESUMED_OPTIONS}
+
+# --resume continues the export with the options it was started with: the ones
+# not given again are taken from its state, and giving different ones is an error
+def restoreExportOptions(options):
+    for name, value in options.items():
+        current = getattr(args, name)
+        if current == parser.get_default(name):
+            setattr(args, name, value)
+        elif current != value:
+            parser.error("--{0} {1} differs from the {2} the export to resume was started with".format(
+                name, current, value))
+
 # This method is used in order to create a empty Channel if you do not export public channels
 # otherwise, the viewer will error and not show the root screen. Rather than forking the editor, I work with it.
+# Returns the channel, which has to be listed in channels.json, or None if the
+# workspace has no public channel.
 def dumpDummyChannel():
-    channelName = channels[0]['name']
+    # public channels aren't listed when only groups are exported. A page can
+    # come back empty while there are more, so pages are read until one has a channel.
+    pages = Paginator(
+        lambda cursor: slack.conversations.list(cursor=cursor, limit=100, types=('public_channel')),
+        'channels',
+        itemName='channels',
+        stream=True)
+    channel = next((channel for page in pages for channel in page), None)
+    if channel is None:
+        return None
+    fetchMembers([channel])
+    channelName = channel['name']
     mkdir( channelName )
     fileDate = '{:%Y-%m-%d}'.format(datetime.today())
     outFileName = '{room}/{file}.json'.format( room = channelName, file = fileDate )
     writeMessageFile(outFileName, [])
+    return channel
+
+class DownloadManifest(object):
+    """
+    SQLite database kept in the files.slack.com folder, recording for every file its URL,
+    path (relative to that folder), size and download status, and for every day file the
+    size and modification time it had once its links were rewritten.
+
+    Re-runs skip day files that haven't changed since, and only fetch files that aren't
+    recorded as downloaded, without scanning the folder.
+    """
+    fileName = '.manifest.sqlite'
+    commitEvery = 1000
+
+    def __init__(self, filesDirectory):
+        self.connection = sqlite3.connect(os.path.join(filesDirectory, self.fileName),
+                                          check_same_thread=False)
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, url TEXT, size INTEGER, status TEXT)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS day_files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)")
+            self.connection.commit()
+
+    def _write(self, statement, parameters):
+        with self.lock:
+            self.connection.execute(statement, parameters)
+            self.uncommitted += 1
+            if self.uncommitted >= self.commitEvery:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def status(self, path):
+        with self.lock:
+            row = self.connection.execute("SELECT status FROM files WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def record(self, path, url, status, size=None):
+        self._write("INSERT OR REPLACE INTO files (path, url, size, status) VALUES (?, ?, ?, ?)",
+                    (path, url, size, status))
+
+    def unfinished(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT path, url, size FROM files WHERE status != 'done'").fetchall()
+
+    def isUnchanged(self, dayFile):
+        stat = os.stat(dayFile)
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime_ns FROM day_files WHERE path = ?",
+                                          (os.path.abspath(dayFile),)).fetchone()
+        return row == (stat.st_size, stat.st_mtime_ns)
+
+    def markProcessed(self, dayFile):
+        stat = os.stat(dayFile)
+        self._write("INSERT OR REPLACE INTO day_files (path, size, mtime_ns) VALUES (?, ?, ?)",
+                    (os.path.abspath(dayFile), stat.st_size, stat.st_mtime_ns))
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+# errors of a download attempt, which is tried again
+DOWNLOAD_ERRORS = (OSError, asyncio.TimeoutError, requests.exceptions.RequestException) + (
+    (aiohttp.ClientError,) if aiohttp else ())
+
+class FileDownloader(object):
+    """
+    Downloads files from files.slack.com on a pool of worker threads, reusing the pooled
+    connections of the Slacker session (of the AsyncSlacker client with --asyncTransport).
+
+    Bodies are streamed in chunks to a ".part" file next to their destination. An interrupted
+    download is resumed from where it stopped with a Range request (in later attempts, or later
+    runs), and the file is only renamed into place once its size matches the one Slack reports,
+    so a truncated download never looks finished.
+
+    With dedup set to "hardlink" or "symlink", completed files are moved into a content-addressed
+    store (blobDirectory, one blob per SHA-256) and linked from the path the viewer expects, so
+    identical files shared under different IDs are only stored once.
+    """
+    chunkSize = 1024 * 1024
+    attempts = 3
+
+    def __init__(self, workers, manifest=None, dedup=None, blobDirectory=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.manifest = manifest
+        self.dedup = dedup
+        self.blobDirectory = blobDirectory
+        self.duplicates = 0
+        self.savedBytes = 0
+        self.pending = []
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.queuedBytes = 0
+        self.failed = 0
+        self.start = time.monotonic()
+
+    # expectedSize is the 'size' of the Slack file object, when downloading the original
+    # (thumbnails don't have a size)
+    def submit(self, url, localFile, path=None, expectedSize=None):
+        # the same file is often linked from several fields or messages
+        with self.lock:
+            if localFile in self.queued:
+                return
+            self.queued.add(localFile)
+            self.queuedBytes += expectedSize or 0
+        if self.manifest:
+            self.manifest.record(path, url, 'pending', expectedSize)
+        self.pending.append(self.pool.submit(self._download, url, localFile, path, expectedSize))
+
+    def _failed(self, url, path, expectedSize, error):
+        print("Failed downloading %s: %s" % (url, error))
+        if self.manifest:
+            self.manifest.record(path, url, 'failed', expectedSize)
+        with self.lock:
+            self.failed += 1
+
+    # appends what's missing from partFile, returns the number of bytes received and the
+    # total size announced by the server (None if it didn't)
+    def _fetch(self, url, partFile):
+        offset = os.path.getsize(partFile) if os.path.exists(partFile) else 0
+        if asyncSlack:
+            with open(partFile, 'ab') as outFile:
+                return runOnLoop(asyncSlack.files.download(url, outFile, self.chunkSize, offset=offset))
+
+        headers = {'Range': 'bytes=%d-' % offset} if offset else None
+        try:
+            response = slack.files.download(url, stream=True, headers=headers)
+        except requests.exceptions.HTTPError as e:
+            # nothing left to fetch past the end of the part file
+            if offset and e.response.status_code == requests.codes.range_not_satisfiable:
+                return 0, offset
+            raise
+
+        with response:
+            if response.status_code == requests.codes.partial_content:
+                totalSize = response.headers.get('Content-Range', '').rpartition('/')[2]
+                mode = 'ab'
+            else:
+                # the server ignored the range and sent the whole file again
+                totalSize = response.headers.get('Content-Length')
+                mode = 'wb'
+            received = 0
+            with open(partFile, mode) as outFile:
+                for chunk in response.iter_content(self.chunkSize):
+                    outFile.write(chunk)
+                    received += len(chunk)
+        return received, int(totalSize) if totalSize and totalSize.isdigit() else None
+
+    def _download(self, url, localFile, path, expectedSize):
+        print("Downloading %s, saving to %s" % (url, localFile))
+        partFile = localFile + '.part'
+        received = 0
+        for attempt in range(self.attempts):
+            try:
+                receivedNow, totalSize = self._fetch(url, partFile)
+                received += receivedNow
+            except DOWNLOAD_ERRORS as e:
+                error = e
+                continue
+
+            size = os.path.getsize(partFile)
+            expected = expectedSize if expectedSize is not None else totalSize
+            if expected is None or size == expected:
+                self._store(partFile, localFile, size)
+                break
+            if size > expected:
+                # not the file we were resuming, start over
+                os.remove(partFile)
+            error = "got %d of %d bytes" % (size, expected)
+        else:
+            with self.lock:
+                self.bytes += received
+            self._failed(url, path, expectedSize, error)
+            return
+
+        if self.manifest:
+            self.manifest.record(path, url, 'done', size)
+        with self.lock:
+            self.files += 1
+            self.bytes += received
+
+    def _hash(self, fileName):
+        digest = hashlib.sha256()
+        with open(fileName, 'rb') as inFile:
+            for chunk in iter(lambda: inFile.read(self.chunkSize), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    # moves a completed part file into place, through the content-addressed store with dedup
+    def _store(self, partFile, localFile, size):
+        if not self.dedup:
+            os.replace(partFile, localFile)
+            return
+
+        digest = self._hash(partFile)
+        blob = os.path.join(self.blobDirectory, digest[:2], digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            os.remove(partFile)
+            with self.lock:
+                self.duplicates += 1
+                self.savedBytes += size
+        else:
+            os.replace(partFile, blob)
 
-def downloadFiles(token, cookie_header=None):
+        # link under the part file's name first, so localFile is replaced atomically
+        if self.dedup == 'symlink':
+            os.symlink(os.path.relpath(blob, os.path.dirname(localFile)), partFile)
+        else:
+            os.link(blob, partFile)
+        os.replace(partFile, localFile)
+
+    # waits for the queued downloads, reporting progress every progressInterval seconds
+    def wait(self, progressInterval=30):
+        pending = self.pending
+        while pending:
+            done, pending = waitForFutures(pending, timeout=progressInterval)
+            for future in done:
+                future.result()
+            if pending:
+                print(self.progress())
+        self.pending = []
+        print(self.summary())
+
+    # ETA from the sizes of the queued files (only known for originals)
+    def progress(self):
+        with self.lock:
+            finished, queued, received = self.files + self.failed, len(self.queued), self.bytes
+        progress = "Downloaded {0} of {1} files".format(finished, queued)
+        if self.queuedBytes:
+            bytesPerSecond = received / max(time.monotonic() - self.start, 1e-9)
+            progress += " ({0:.1f} of {1:.1f} MB".format(
+                received / (1024 * 1024), self.queuedBytes / (1024 * 1024))
+            if bytesPerSecond > 0:
+                progress += ", about {0:.0f}s left".format(
+                    max(self.queuedBytes - received, 0) / bytesPerSecond)
+            progress += ")"
+        return progress
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        megabytes = self.bytes / (1024 * 1024)
+        summary = "Downloaded {0} files ({1:.1f} MB) in {2:.1f}s: {3:.2f} MB/s, {4:.1f} files/s, {5} failed".format(
+            self.files, megabytes, elapsed, megabytes / elapsed, self.files / elapsed, self.failed)
+        if self.dedup:
+            summary += "\nDeduplicated {0} of {1} files, saving {2:.1f} MB".format(
+                self.duplicates, self.files, self.savedBytes / (1024 * 1024))
+        return summary
+
+class DownloadPolicy(object):
+    """
+    Decides which files --downloadSlackFiles fetches, and which of their variants (the
+    original, thumbnails, video/pdf previews, ...).
+
+    Files over maxFileSize bytes, or whose mimetype doesn't match the allowTypes/denyTypes
+    patterns (e.g. "image/*"), aren't downloaded and keep their links to Slack. Variants
+    that aren't downloaded are linked to the local copy of the variant that is, so every
+    link of a downloaded file points to a local file.
+
+    variants is one of:
+        all        every variant (the default)
+        original   only the original file
+        thumbnail  the original and the thumbnail closest to (not larger than) thumbSize
+    """
+    originalKeys = ('url_private', 'url_private_download')
+    thumbnailKey = re.compile(r'^thumb_(\d+)$')
+
+    def __init__(self, variants='all', thumbSize=360, maxFileSize=None, allowTypes=None, denyTypes=None):
+        self.variants = variants
+        self.thumbSize = thumbSize
+        self.maxFileSize = maxFileSize
+        self.allowTypes = allowTypes
+        self.denyTypes = denyTypes
+
+    def wantsFile(self, slackFile):
+        if self.maxFileSize is not None and slackFile.get('size', 0) > self.maxFileSize:
+            return False
+        mimetype = slackFile.get('mimetype', '')
+        if self.allowTypes and not any(fnmatch(mimetype, pattern) for pattern in self.allowTypes):
+            return False
+        if self.denyTypes and any(fnmatch(mimetype, pattern) for pattern in self.denyTypes):
+            return False
+        return True
+
+    def _thumbnail(self, links):
+        sizes = [int(match.group(1)) for match in map(self.thumbnailKey.match, links) if match]
+        sizes = [size for size in sizes if size <= self.thumbSize]
+        return 'thumb_%d' % max(sizes) if sizes else None
+
+    # Returns the key of the variant whose local copy the link under key should point to,
+    # given the files.slack.com links of the file by key
+    def source(self, links, key):
+        if self.variants == 'all':
+            return key
+        original = next((originalKey for originalKey in self.originalKeys if originalKey in links), key)
+        if self.variants == 'thumbnail' and self.thumbnailKey.match(key):
+            return self._thumbnail(links) or original
+        return original
+
+# Points the files.slack.com links of a message's files to their local copy (suitable for
+# use with slack-export-viewer if files.slack.com is linked), queueing the downloads that
+# are still needed. Returns True if any link was replaced.
+def localizeFiles(msg):
+    changed = False
+    for slackFile in msg.get("files", []):
+        if localizeFile(slackFile):
+            changed = True
+    return changed
+
+# Same as localizeFiles, for a single Slack file object
+def localizeFile(slackFile):
+    changed = False
+    # Skip deleted files
+    if slackFile.get("mode") != "tombstone" and downloadPolicy.wantsFile(slackFile):
+        # Find all entries referring to files on files.slack.com
+        links = {key: value for key, value in slackFile.items()
+                 if isinstance(value, str) and value.startswith("https://files.slack.com/")}
+
+        for key in links:
+            source = downloadPolicy.source(links, key)
+            url = urlparse(links[source])
+            # only the original has a known size
+            expectedSize = slackFile.get('size') if source in DownloadPolicy.originalKeys else None
+
+            path = url.path[1:]  # Need to discard first "/" in URL, because:
+                # "If a component is an absolute path, all previous components are thrown away and joining continues
+                # from the absolute path component."
+            localFile = os.path.join(FILES_DIRECTORY, path)
+            if zipExport and args.zipFiles:
+                zipExport.includeFile(localFile, os.path.join("files.slack.com", path))
+
+            # Replace URL in data
+            slackFile[key] = "/static/files.slack.com%s" % url.path
+            changed = True
+
+            status = fileManifest.status(path)
+            if status == 'done':
+                continue
+
+            # Check if file already downloaded (before the manifest existed), with the expected size
+            # (or a non-zero size for thumbnails, which don't have a size)
+            if status is None and os.path.exists(localFile):
+                localSize = os.path.getsize(localFile)
+                if localSize == expectedSize or (expectedSize is None and localSize > 0):
+                    fileManifest.record(path, url.geturl(), 'done', localSize)
+                    continue
+
+            # Create folder structure
+            os.makedirs(os.path.dirname(localFile), exist_ok=True)
+
+            # Download files
+            fileDownloader.submit(url.geturl(), localFile, path, expectedSize)
+    return changed
+
+# Starts the background downloads of --downloadSlackFiles, retrying what previous runs didn't
+# manage to download. Files are queued by writeMessageFile as the export writes day files.
+def startFileDownloads():
+    global fileManifest, fileDownloader
+    print("Starting to download files")
+    mkdir(FILES_DIRECTORY)
+    fileManifest = DownloadManifest(FILES_DIRECTORY)
+    fileDownloader = FileDownloader(args.downloadWorkers, fileManifest, dedup=args.dedupFiles,
+                                    blobDirectory=os.path.join(FILES_DIRECTORY, ".blobs"))
+
+    for path, url, expectedSize in fileManifest.unfinished():
+        fileDownloader.submit(url, os.path.join(FILES_DIRECTORY, path), path, expectedSize)
+
+# Lists the files shared in a conversation between tsFrom and tsTo (Unix timestamps,
+# None for no limit) with files.list, without fetching its history
+def listFiles(channelId, tsFrom=None, tsTo=None, pageSize=200):
+    paginator = PageNumberPaginator(
+        lambda page: slack.files.list(
+            channel=channelId, ts_from=tsFrom, ts_to=tsTo, count=pageSize, page=page).body,
+        'files', progressChar='.', itemName='files')
+    files = []
+    for page in paginator:
+        files.extend(page)
+
+    print("\nListed {0} from {1}".format(paginator.summary(), channelId))
+    return files
+
+# Converts a YYYY-MM-DD date (UTC) of --filesFrom/--filesTo to a Unix timestamp,
+# the end of the day when endOfDay is set
+def dateToTimestamp(date, endOfDay=False):
+    if date is None:
+        return None
+    timestamp = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+    if endOfDay:
+        timestamp += 24 * 60 * 60 - 1
+    return int(timestamp)
+
+# --filesOnly: downloads the files shared in the given conversations, found with
+# files.list instead of walking their history, and writes the listed file objects
+# (linking to the local copies) to files.json. Returns the names of the
+# conversations whose files couldn't be listed.
+def fetchFiles(conversations):
+    print("Listing files of", len(conversations), "conversations")
+    tsFrom = dateToTimestamp(args.filesFrom)
+    tsTo = dateToTimestamp(args.filesTo, endOfDay=True)
+    filesById = {}
+    lock = threading.Lock()
+
+    def listConversationFiles(conversation):
+        files = listFiles(conversation['id'], tsFrom, tsTo)
+        # a file shared in several of the conversations is listed for each of them
+        with lock:
+            for slackFile in files:
+                filesById.setdefault(slackFile['id'], slackFile)
+
+    scheduleExports(conversations, listConversationFiles, workspace.conversationName)
+    failures = waitForExports()
+
+    files = sorted(filesById.values(), key=lambda slackFile: slackFile.get('timestamp', 0))
+    wanted = [slackFile for slackFile in files if downloadPolicy.wantsFile(slackFile)]
+    print("Found {0} files, downloading {1} ({2:.1f} MB)".format(
+        len(files), len(wanted), sum(slackFile.get('size', 0) for slackFile in wanted) / (1024 * 1024)))
+    if dryRun:
+        return failures
+
+    for slackFile in files:
+        localizeFile(slackFile)
+    jsonWriter.write("files.json", files)
+    return failures
+
+def downloadFiles():
     """
-    Iterate through all json files, downloads files stored on files.slack.com and replaces the link with a local one
+    Iterate through the json files this export didn't write itself (e.g. those of a previous
+    export), downloads files stored on files.slack.com and replaces the link with a local one,
+    then waits for all downloads to finish
 
     Args:
         jsonDirectory: folder where the json files are in, will be searched recursively
     """
-    print("Starting to download files")
     for root, subdirs, files in os.walk("."):
         for filename in files:
-            if not filename.endswith('.json'):
+            if not isJsonFile(filename):
                 continue
             filePath = os.path.join(root, filename)
-            data = []
-            with open(filePath) as inFile:
-                data = json.load(inFile)
-                for msg in data:
-                    for slackFile in msg.get("files", []):
-                        # Skip deleted files
-                        if slackFile.get("mode") == "tombstone":
-                            continue
-
-                        for key, value in slackFile.items():
-                            # Find all entries referring to files on files.slack.com
-                            if not isinstance(value, str) or not value.startswith("https://files.slack.com/"):
-                                continue
-
-                            url = urlparse(value)
-
-                            localFile = os.path.join("../files.slack.com", url.path[1:])  # Need to discard first "/" in URL, because:
-                                # "If a component is an absolute path, all previous components are thrown away and joining continues
-                                # from the absolute path component."
-                            print("Downloading %s, saving to %s" % (url.geturl(), localFile))
-
-                            # Create folder structure
-                            os.makedirs(os.path.dirname(localFile), exist_ok=True)
-
-                            # Replace URL in data - suitable for use with slack-export-viewer if files.slack.com is linked
-                            slackFile[key] = "/static/files.slack.com%s" % url.path
-
-                            # Check if file already downloaded, with a non-zero size
-                            # (can't check for same size because thumbnails don't have a size)
-                            if os.path.exists(localFile) and (os.path.getsize(localFile) > 0):
-                                print("Skipping already downloaded file: %s" % localFile)
-                                continue
-
-                            # Download files
-                            headers = {"Authorization": f"Bearer {token}",
-                            **cookie_header}
-                            r = requests.get(url.geturl(), headers=headers)
-                            try: 
-                                open(localFile, 'wb').write(r.content)
-                            except FileNotFoundError: 
-                                print("File writing error-still all broken")
-                                continue
-                            
-
-            # Save updated data to json file
-            with open(filePath, "w") as outFile:
-                json.dump(data, outFile, indent=4, sort_keys=True)
-
-            print("Replaced all files in %s" % filePath)
-
-def finalize():
-    os.chdir('..')
-    if zipName:
-        shutil.make_archive(zipName, 'zip', outputDirectory, None)
+            # links already rewritten, and downloads queued, when the file was written
+            if fileManifest.isUnchanged(filePath):
+                continue
+            changed = False
+            data = readJsonFile(filePath)
+            for msg in data:
+                if localizeFiles(msg):
+                    changed = True
+
+            # Save updated data to json file, if any link was replaced
+            if changed:
+                filePath = jsonWriter.write(filePath, data)
+
+                print("Replaced all files in %s" % filePath)
+            fileManifest.markProcessed(filePath)
+
+    fileDownloader.wait()
+    fileManifest.close()
+
+def finalize(exitStatus=0):
+    metadataCache.close()
+    if asyncSlack:
+        runOnLoop(asyncSlack.close())
+    # the checkpoints of conversations that failed are kept for --resume
+    if checkpointDirectory and os.path.isdir(checkpointDirectory) and not os.listdir(checkpointDirectory):
+        os.rmdir(checkpointDirectory)
+    os.chdir(os.path.dirname(outputDirectory))
+    if zipExport:
+        # only the export state (and empty conversation folders) was written to disk
+        stateFile = os.path.join(outputDirectory, ExportState.fileName)
+        if os.path.exists(stateFile):
+            zipExport.includeFile(stateFile, ExportState.fileName)
+        zipExport.close()
         shutil.rmtree(outputDirectory)
-    exit()
+    elif zipName:
+        shutil.make_archive(zipName, 'zip', outputDirectory, None)
+        # an incremental or resumed export keeps its directory for the next run
+        if not (args.incremental or args.resume):
+            shutil.rmtree(outputDirectory)
+    exit(exitStatus)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Export Slack history')
@@ -1797,6 +3840,11 @@ if __name__ == "__main__":
     parser.add_argument('--token', required=True, help="Slack API token")
     parser.add_argument('--cookie', help="a set of cookies for the xoxc api token")
     parser.add_argument('--zip', help="Name of a zip file to output as")
+    parser.add_argument(
+        '--zipFiles',
+        action='store_true',
+        default=False,
+        help="With --zip and --downloadSlackFiles, also store the downloaded files in the zip (under files.slack.com/)")
 
     parser.add_argument(
         '--dryRun',
@@ -1838,6 +3886,93 @@ if __name__ == "__main__":
         help="Downloads files from files.slack.com for local access, stored in 'files.slack.com' folder. "
             "Link this folder inside slack-export-viewer/slackviewer/static/ to have it work seamless with slack-export-viewer")
 
+    parser.add_argument(
+        '--filesOnly',
+        action='store_true',
+        default=False,
+        help="Only download the files shared in the selected conversations (listed with files.list, "
+            "without fetching their history) and write them to files.json. Implies --downloadSlackFiles")
+
+    parser.add_argument(
+        '--filesFrom',
+        metavar='YYYY-MM-DD',
+        help="With --filesOnly, only download files shared on or after this date (UTC)")
+
+    parser.add_argument(
+        '--filesTo',
+        metavar='YYYY-MM-DD',
+        help="With --filesOnly, only download files shared on or before this date (UTC)")
+
+    parser.add_argument(
+        '--fileVariants',
+        choices=('all', 'original', 'thumbnail'),
+        default='all',
+        help="Which variants of each file --downloadSlackFiles fetches: every thumbnail and preview (all, the default), "
+            "only the original file (original), or the original and one thumbnail (thumbnail, see --thumbSize). "
+            "Links to the other variants point to the downloaded one")
+
+    parser.add_argument(
+        '--thumbSize',
+        type=int,
+        default=360,
+        metavar='PIXELS',
+        help="Largest thumbnail size downloaded with --fileVariants thumbnail (default: 360)")
+
+    parser.add_argument(
+        '--maxFileSize',
+        type=float,
+        default=None,
+        metavar='MB',
+        help="Don't download files larger than this; they keep their links to Slack")
+
+    parser.add_argument(
+        '--fileTypes',
+        nargs='+',
+        default=None,
+        metavar='MIMETYPE',
+        help="Only download files whose mimetype matches one of these patterns (e.g. 'image/*' application/pdf)")
+
+    parser.add_argument(
+        '--excludeFileTypes',
+        nargs='+',
+        default=None,
+        metavar='MIMETYPE',
+        help="Don't download files whose mimetype matches one of these patterns (e.g. 'video/*')")
+
+    parser.add_argument(
+        '--dedupFiles',
+        nargs='?',
+        choices=('hardlink', 'symlink'),
+        const='hardlink',
+        default=None,
+        help="Store each distinct downloaded file once, in files.slack.com/.blobs, and link to it "
+            "(with hard links unless 'symlink' is given) from the paths the viewer expects")
+
+    parser.add_argument(
+        '--downloadWorkers',
+        type=int,
+        default=8,
+        metavar='N',
+        help="Number of files downloaded concurrently with --downloadSlackFiles (default: 8)")
+
+    parser.add_argument(
+        '--jsonStyle',
+        choices=JsonWriter.styles,
+        default='pretty',
+        help="Write indented JSON files (pretty, the default) or JSON files without whitespace (compact, about half the size)")
+
+    parser.add_argument(
+        '--jsonBackend',
+        choices=('json', 'orjson'),
+        default=None,
+        help="JSON library used to write the export (default: orjson for compact files if it's installed, which is faster, json otherwise)")
+
+    parser.add_argument(
+        '--compress',
+        choices=('gzip', 'zstd'),
+        default=None,
+        help="Compress each JSON file of the export, as .json.gz or .json.zst (zstd requires zstandard)")
+
     parser.add_argument(
         '--excludeArchived',
         action='store_true',
@@ -1850,35 +3985,156 @@ if __name__ == "__main__":
         default=False,
         help="Only export public channels if the user is a member of the channel")
 
+    parser.add_argument(
+        '--cacheTtl',
+        type=float,
+        default=0,
+        metavar='MINUTES',
+        help="Reuse the conversation lists, members and users fetched by previous runs for this long (default: 0, not cached)")
+
+    parser.add_argument(
+        '--cacheDir',
+        default=os.path.join(os.path.expanduser('~'), '.cache', 'slack-export'),
+        metavar='DIR',
+        help="Where --cacheTtl keeps workspace metadata, in one file per team (default: ~/.cache/slack-export)")
+
+    parser.add_argument(
+        '--refreshCache',
+        action='store_true',
+        default=False,
+        help="Fetch all workspace metadata again, and cache it for the next runs")
+
+    parser.add_argument(
+        '--incremental',
+        metavar='PREVIOUS_EXPORT_DIR',
+        help="Add only the messages newer than the previous export to its directory")
+
+    parser.add_argument(
+        '--resume',
+        metavar='EXPORT_DIR',
+        help="Continue an export that stopped (e.g. crashed) where it left off, skipping the conversations it finished")
+
+    parser.add_argument(
+        '--conversationWorkers',
+        type=int,
+        default=1,
+        metavar='N',
+        help="Number of conversations exported concurrently (default: 1)")
+
+    parser.add_argument(
+        '--threadWorkers',
+        type=int,
+        default=4,
+        metavar='N',
+        help="Number of threads fetching thread replies concurrently (default: 4)")
+
+    parser.add_argument(
+        '--threadLookback',
+        type=int,
+        default=DEFAULT_THREAD_LOOKBACK,
+        metavar='DAYS',
+        help="With --incremental, check the threads started in the last DAYS days for new replies (default: {0})".format(DEFAULT_THREAD_LOOKBACK))
+
+    parser.add_argument(
+        '--memoryBudget',
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+        metavar='MB',
+        help="Megabytes of messages held in memory per conversation before they are spilled to temporary files (default: {0})".format(DEFAULT_MEMORY_BUDGET // (1024 * 1024)))
+
+    parser.add_argument(
+        '--asyncTransport',
+        action='store_true',
+        default=False,
+        help="Fetch history, replies and files with asyncio on a single thread (requires aiohttp)")
+
+    parser.add_argument(
+        '--asyncConnections',
+        type=int,
+        default=DEFAULT_ASYNC_CONNECTIONS,
+        metavar='N',
+        help="With --asyncTransport, number of connections opened to each Slack host (default: {0})".format(DEFAULT_ASYNC_CONNECTIONS))
+
+    parser.add_argument(
+        '--httpPoolSize',
+        type=int,
+        default=None,
+        metavar='N',
+        help="Number of HTTP connections kept open to Slack (default: one per worker thread)")
+
+    parser.add_argument(
+        '--keepAlive',
+        type=int,
+        default=DEFAULT_KEEP_ALIVE,
+        metavar='SECONDS',
+        help="Idle seconds before TCP keep-alive probes are sent on pooled connections, 0 for the system default (default: {0})".format(DEFAULT_KEEP_ALIVE))
+
     args = parser.parse_args()
+    if args.resume:
+        restoreExportOptions(ExportState(os.path.abspath(args.resume)).options)
 
-    users = []
-    channels = []
-    groups = []
-    dms = []
-    userNamesById = {}
-    userIdsByName = {}
+    workspace = WorkspaceDirectory()
+    messageAuthors = set()
 
     cookie_header = {'cookie': args.cookie}
-    slack = Slacker(headers=cookie_header, token=args.token)
+    slack = Slacker(headers=cookie_header, token=args.token,
+                    pool_size=args.httpPoolSize or max(args.conversationWorkers + args.threadWorkers, args.downloadWorkers),
+                    keep_alive=args.keepAlive)
+    replyPool = ThreadPoolExecutor(max_workers=args.threadWorkers)
+    asyncSlack = None
+    if args.asyncTransport:
+        # the conversation workers hand their requests to one event loop thread
+        asyncLoop = asyncio.new_event_loop()
+        threading.Thread(target=asyncLoop.run_forever, daemon=True).start()
+        asyncSlack = runOnLoop(AsyncSlacker(
+            headers=cookie_header, token=args.token,
+            rate_limiter=slack.rate_limiter,
+            pool_size=args.asyncConnections).open())
+    conversationPool = ThreadPoolExecutor(max_workers=args.conversationWorkers)
+    scheduledExports = {}
     testAuth = doTestAuth()
     tokenOwnerId = testAuth['user_id']
+    metadataCache = MetadataCache()
+    if args.cacheTtl or args.refreshCache:
+        metadataCache = MetadataCache(args.cacheDir, testAuth['team_id'], args.cacheTtl * 60, args.refreshCache)
 
     bootstrapKeyValues()
 
     dryRun = args.dryRun
     zipName = args.zip
-
-    outputDirectory = "{0}-slack_export".format(datetime.today().strftime("%Y%m%d-%H%M%S"))
+    # the export is streamed into the zip, unless it's kept for the next incremental export
+    zipExport = None
+    if zipName and not (args.incremental or args.resume) and not dryRun:
+        zipExport = ZipExport(os.path.abspath(zipName + '.zip'))
+    jsonWriter = JsonWriter(args.jsonStyle, args.jsonBackend, zipExport, args.compress)
+
+    if args.resume or args.incremental:
+        outputDirectory = args.resume or args.incremental
+    else:
+        outputDirectory = "{0}-slack_export".format(datetime.today().strftime("%Y%m%d-%H%M%S"))
+    outputDirectory = os.path.abspath(outputDirectory)
     mkdir(outputDirectory)
     os.chdir(outputDirectory)
-
+    exportState = ExportState(outputDirectory, resume=bool(args.resume))
     if not dryRun:
-        dumpUserFile()
-        dumpChannelFile()
+        exportState.setOptions(exportOptions())
+    # the progress of every conversation is saved there while it's exported, except
+    # when streaming to a zip, which can't be resumed
+    checkpointDirectory = None
+    if not zipExport:
+        checkpointDirectory = os.path.join(outputDirectory, '.checkpoint')
+
+    fileManifest = None
+    fileDownloader = None
+    downloadPolicy = DownloadPolicy(
+        variants=args.fileVariants,
+        thumbSize=args.thumbSize,
+        maxFileSize=args.maxFileSize * 1024 * 1024 if args.maxFileSize is not None else None,
+        allowTypes=args.fileTypes,
+        denyTypes=args.excludeFileTypes)
 
     selectedChannels = selectConversations(
-        channels,
+        'channels',
         args.publicChannels,
         filterConversationsByName,
         promptForPublicChannels)
@@ -1886,29 +4142,58 @@ if __name__ == "__main__":
         selectedChannels  = [ channel for channel in selectedChannels if channel["is_member"] ]
 
     selectedGroups = selectConversations(
-        groups,
+        'groups',
         args.groups,
         filterConversationsByName,
         promptForGroups)
 
     selectedDms = selectConversations(
-        dms,
+        'dms',
         args.directMessages,
         filterDirectMessagesByUserNameOrId,
         promptForDirectMessages)
+    # for the names of the DMs
+    loadUsers(dm['user'] for dm in selectedDms)
 
-    if len(selectedChannels) > 0:
-        fetchPublicChannels(selectedChannels)
+    if not dryRun:
+        # members are only needed for the conversations exported
+        fetchMembers(selectedChannels + selectedGroups)
+        exportedChannels = selectedChannels
+        if len(selectedGroups) > 0 and len(selectedChannels) == 0 and not args.filesOnly:
+            dummyChannel = dumpDummyChannel()
+            exportedChannels = [dummyChannel] if dummyChannel else []
+        dumpChannelFile(exportedChannels, selectedGroups, selectedDms)
+
+    if (args.downloadSlackFiles or args.filesOnly) and not dryRun:
+        startFileDownloads()
+
+    if args.filesOnly:
+        failures = fetchFiles(selectedChannels + selectedGroups + selectedDms)
+        if fileDownloader:
+            fileDownloader.wait()
+            fileManifest.close()
+    else:
+        conversationDirectories = {}
+        if not dryRun:
+            conversationDirectories = planDirectories(selectedChannels + selectedGroups)
 
-    if len(selectedGroups) > 0:
-        if len(selectedChannels) == 0:
-            dumpDummyChannel()
-        fetchGroups(selectedGroups)
+        if len(selectedChannels) > 0:
+            fetchPublicChannels(selectedChannels)
 
-    if len(selectedDms) > 0:
-        fetchDirectMessages(selectedDms)
+        if len(selectedGroups) > 0:
+            fetchGroups(selectedGroups)
 
-    if args.downloadSlackFiles:
-        downloadFiles(token=args.token, cookie_header=cookie_header)
+        if len(selectedDms) > 0:
+            fetchDirectMessages(selectedDms)
+
+        failures = waitForExports()
+
+        if fileDownloader:
+            downloadFiles()
+
+    if not dryRun:
+        loadUsers(exportedUserIds(selectedChannels + selectedGroups + selectedDms))
+        dumpUserFile()
 
-    finalize()
+    # exiting with 1 lets scripts (e.g. a nightly job) know that the export has to be resumed
+    finalize(1 if failures else 0)
@@ -0,0 +1,416 @@
+import asyncio
+import collections
+import contextlib
+import glob
+import gzip
+import io
+import json
+import os
+import runpy
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+import slack_export
+from slack_export import (AsyncSlacker, Channels, ExportState, Files, JsonWriter, RateLimiter, Response, Users,
+                          aiohttp, planDirectories, readJsonFile)
+
+
+class ResponseTest(unittest.TestCase):
+    def items(self, text, key='messages'):
+        response = Response(text)
+        return list(response.iter_items(key)), response.body
+
+    def test_iter_items(self):
+        items, rest = self.items('{"ok":true,"messages":[{"ts":"1"},{"ts":"2"}],"has_more":false}')
+        self.assertEqual(items, [{'ts': '1'}, {'ts': '2'}])
+        self.assertEqual(rest, {'ok': True, 'has_more': False})
+
+    def test_iter_items_trailing_newline(self):
+        items, rest = self.items('{"ok":true,"messages":[{"ts":"1"}]}\n')
+        self.assertEqual(items, [{'ts': '1'}])
+        self.assertEqual(rest, {'ok': True})
+
+    def test_iter_items_whitespace_after_brackets(self):
+        items, rest = self.items('{ "ok" : true , "messages" : [ {"ts":"1"} , {"ts":"2"} ] ,"x":1 }\n')
+        self.assertEqual(items, [{'ts': '1'}, {'ts': '2'}])
+        self.assertEqual(rest, {'ok': True, 'x': 1})
+
+    def test_iter_items_empty(self):
+        self.assertEqual(self.items('{"ok":true,"messages":[ ] }\n'), ([], {'ok': True}))
+        self.assertEqual(self.items('{ }\n'), ([], {}))
+
+    def test_iter_items_missing_key(self):
+        self.assertEqual(self.items('{"ok":true,"channels":[{"id":"C1"}]}'),
+                         ([], {'ok': True, 'channels': [{'id': 'C1'}]}))
+
+    def test_iter_items_truncated(self):
+        with self.assertRaises(ValueError):
+            self.items('{"ok":true,"messages":[{"ts":"1"}')
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_pause_holds_back_waiting_callers(self):
+        # 60 requests per minute: a burst of 6, then one per second
+        limiter = RateLimiter({'test.method': 60})
+        for _ in range(6):
+            limiter.acquire('test.method')
+
+        start = time.monotonic()
+        waiter = threading.Thread(target=limiter.acquire, args=('test.method',))
+        waiter.start()
+        time.sleep(0.2)
+        # a 429 while the waiter sleeps on its token
+        limiter.pause('test.method', 1.5)
+        waiter.join()
+        self.assertGreaterEqual(time.monotonic() - start, 1.6)
+
+
+class UsersTest(unittest.TestCase):
+    def test_get_user_id_lists_every_page_once(self):
+        pages = {
+            None: '{"ok":true,"members":[{"id":"U1","name":"ann"}],"response_metadata":{"next_cursor":"2"}}',
+            '2': '{"ok":true,"members":[{"id":"U2","name":"bob"}],"response_metadata":{"next_cursor":""}}',
+        }
+        calls = []
+
+        def listPage(presence=False, cursor=None, limit=None):
+            calls.append(cursor)
+            return Response(pages[cursor])
+
+        users = Users()
+        users.list = listPage
+        self.assertEqual(users.get_user_id('bob'), 'U2')
+        self.assertEqual(users.get_user_id('ann'), 'U1')
+        self.assertIsNone(users.get_user_id('nobody'))
+        self.assertIsNone(users.get_user_id('nobody'))
+        self.assertEqual(calls, [None, '2'])
+
+
+class ChannelsTest(unittest.TestCase):
+    def test_get_channel_id_lists_every_page_once(self):
+        pages = {
+            None: '{"ok":true,"channels":[{"id":"C1","name":"general"}],"response_metadata":{"next_cursor":"2"}}',
+            '2': '{"ok":true,"channels":[{"id":"C2","name":"random"}],"response_metadata":{"next_cursor":""}}',
+        }
+        calls = []
+
+        def get(api, params=None):
+            calls.append((api, params['cursor']))
+            return Response(pages[params['cursor']])
+
+        channels = Channels()
+        channels.get = get
+        self.assertEqual(channels.get_channel_id('random'), 'C2')
+        self.assertEqual(channels.get_channel_id('general'), 'C1')
+        self.assertIsNone(channels.get_channel_id('nowhere'))
+        self.assertEqual(calls, [('conversations.list', None), ('conversations.list', '2')])
+
+
+class PlanDirectoriesTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        for name, value in (('exportState', ExportState(self.directory.name)), ('jsonWriter', JsonWriter())):
+            patcher = mock.patch.object(slack_export, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    # a previous export of the given conversations, by ID: directory and day files
+    def exported(self, conversations):
+        for conversationId, (directory, days) in conversations.items():
+            self.writeDays(directory, days)
+        slack_export.exportState.setDirectories(
+            {conversationId: directory for conversationId, (directory, days) in conversations.items()})
+
+    def writeDays(self, directory, days):
+        os.makedirs(directory, exist_ok=True)
+        for day, texts in days.items():
+            JsonWriter().write(os.path.join(directory, day + '.json'),
+                               [{'ts': text, 'text': text} for text in texts])
+
+    def days(self, directory):
+        return {fileName[:-len('.json')]: [message['text'] for message in readJsonFile(os.path.join(directory, fileName))]
+                for fileName in sorted(os.listdir(directory))}
+
+    def test_old_name_reused(self):
+        self.exported({'C1': ('general', {'2024-01-01': ['1']}), 'C2': ('random', {'2024-01-01': ['2']})})
+        roomDirs = planDirectories([{'id': 'C1', 'name': 'announcements'}, {'id': 'C2', 'name': 'general'}])
+        self.assertEqual(roomDirs, {'C1': 'announcements', 'C2': 'general'})
+        self.assertEqual(self.days('announcements'), {'2024-01-01': ['1']})
+        self.assertEqual(self.days('general'), {'2024-01-01': ['2']})
+        self.assertFalse(os.path.exists('random'))
+        self.assertFalse(os.path.exists('.renames'))
+        self.assertEqual(ExportState(self.directory.name).directories, roomDirs)
+
+    def test_old_name_of_conversation_not_exported(self):
+        self.exported({'C1': ('general', {'2024-01-01': ['1']})})
+        roomDirs = planDirectories([{'id': 'C3', 'name': 'general'}])
+        self.assertEqual(roomDirs, {'C3': 'general-C3'})
+        self.assertEqual(self.days('general'), {'2024-01-01': ['1']})
+        self.assertEqual(self.days('general-C3'), {})
+
+    def test_names_swapped(self):
+        self.exported({'C1': ('a', {'2024-01-01': ['1'], '2024-01-02': ['1b']}), 'C2': ('b', {'2024-01-01': ['2']})})
+        roomDirs = planDirectories([{'id': 'C1', 'name': 'b'}, {'id': 'C2', 'name': 'a'}])
+        self.assertEqual(roomDirs, {'C1': 'b', 'C2': 'a'})
+        self.assertEqual(self.days('b'), {'2024-01-01': ['1'], '2024-01-02': ['1b']})
+        self.assertEqual(self.days('a'), {'2024-01-01': ['2']})
+
+    def test_interrupted_move(self):
+        # the previous run moved old aside and had moved one of its files to new
+        self.exported({'C1': ('old', {})})
+        os.rmdir('old')
+        self.writeDays(os.path.join('.renames', 'C1'), {'2024-01-01': ['1', '3'], '2024-01-02': ['4']})
+        self.writeDays('new', {'2024-01-01': ['2', '3'], '2024-01-03': ['5']})
+        roomDirs = planDirectories([{'id': 'C1', 'name': 'new'}])
+        self.assertEqual(roomDirs, {'C1': 'new'})
+        self.assertEqual(self.days('new'), {'2024-01-01': ['1', '2', '3'], '2024-01-02': ['4'], '2024-01-03': ['5']})
+        self.assertFalse(os.path.exists('.renames'))
+
+
+# Minimal local stand-in for the Slack API: a paginated conversations.history,
+# files.upload reporting the size of the uploaded file, and a file to download
+# (gzipped for clients accepting it, like a CDN would)
+class MockSlackHandler(BaseHTTPRequestHandler):
+    download = b'0123456789' * 100000
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, contentType='application/json', encode=False):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        if encode and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/files/download':
+            offset = int(self.headers.get('Range', 'bytes=0-')[6:-1])
+            if not offset:
+                return self.send(self.download, 'application/octet-stream', encode=True)
+            body = self.download[offset:]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (offset, len(self.download) - 1,
+                                                                  len(self.download)))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            return self.wfile.write(body)
+        if url.path == '/api/conversations.history':
+            page = int(query.get('cursor', ['0'])[0])
+            return self.send({'ok': True, 'messages': [{'ts': '%d.000000' % page}],
+                              'response_metadata': {'next_cursor': str(page + 1) if page < 2 else ''}})
+        self.send({'ok': False, 'error': 'unknown_method'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if urlparse(self.path).path == '/api/files.upload':
+            return self.send({'ok': True, 'received': len(body)})
+        self.send({'ok': False, 'error': 'unknown_method'})
+
+
+class MockSlackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockSlackHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FilesTest(MockSlackTestCase):
+    def test_download_unencoded(self):
+        response = Files(token='xoxb-test').download(self.url + 'files/download')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(int(response.headers['Content-Length']), len(MockSlackHandler.download))
+        self.assertEqual(response.content, MockSlackHandler.download)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncSlackerTest(MockSlackTestCase):
+
+    def run_client(self, test):
+        async def run():
+            async with AsyncSlacker('xoxb-test', api_url=self.url + 'api/') as slack:
+                return await test(slack)
+        return asyncio.run(run())
+
+    def test_history_pages(self):
+        async def test(slack):
+            cursor, timestamps = None, []
+            while True:
+                body = (await slack.conversations.history('C1', cursor=cursor)).body
+                timestamps += [message['ts'] for message in body['messages']]
+                cursor = body['response_metadata']['next_cursor']
+                if not cursor:
+                    return timestamps
+        self.assertEqual(self.run_client(test), ['0.000000', '1.000000', '2.000000'])
+
+    def test_upload_path(self):
+        with tempfile.NamedTemporaryFile(delete=False) as uploaded:
+            uploaded.write(b'x' * 1000)
+        try:
+            response = self.run_client(lambda slack: slack.files.upload(file_=uploaded.name))
+        finally:
+            os.remove(uploaded.name)
+        self.assertGreater(response.body['received'], 1000)
+
+    def test_download(self):
+        downloaded = io.BytesIO()
+        written, size = self.run_client(lambda slack: slack.files.download(self.url + 'files/download', downloaded))
+        self.assertEqual(written, len(MockSlackHandler.download))
+        self.assertEqual(size, len(MockSlackHandler.download))
+        self.assertEqual(downloaded.getvalue(), MockSlackHandler.download)
+
+    def test_download_resume(self):
+        downloaded = io.BytesIO()
+        downloaded.write(MockSlackHandler.download[:1000])
+        written, size = self.run_client(
+            lambda slack: slack.files.download(self.url + 'files/download', downloaded, offset=1000))
+        self.assertEqual(written, len(MockSlackHandler.download) - 1000)
+        self.assertEqual(size, len(MockSlackHandler.download))
+        self.assertEqual(downloaded.getvalue(), MockSlackHandler.download)
+
+
+
+# A workspace with two public channels for whole exports: the history of general
+# comes in pages of two messages (newest first, as Slack sends them), the
+# second message starting a thread, and its third page fails once when failing
+class MockWorkspaceHandler(BaseHTTPRequestHandler):
+    channels = [{'id': 'C1', 'name': 'general', 'is_archived': False, 'is_member': True},
+                {'id': 'C2', 'name': 'random', 'is_archived': False, 'is_member': True}]
+    history = [{'type': 'message', 'ts': '17000%05d.000000' % (index * 1000), 'user': 'U1',
+                'text': 'message %d' % index} for index in range(10)]
+    history[1]['thread_ts'] = history[1]['ts']
+    replies = [history[1]] + [{'type': 'message', 'ts': '17000%05d.000000' % (1000 + index), 'user': 'U1',
+                               'thread_ts': '1700001000.000000', 'text': 'reply %d' % index} for index in (1, 2)]
+    pageSize = 2
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, status=200):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        method = url.path.rpartition('/')[2]
+        if method == 'auth.test':
+            return self.send({'ok': True, 'team': 'T', 'team_id': 'T1', 'user': 'me', 'user_id': 'U1'})
+        if method == 'conversations.list':
+            channels = self.channels if 'public_channel' in query.get('types', '') else []
+            return self.send({'ok': True, 'channels': channels, 'response_metadata': {'next_cursor': ''}})
+        if method == 'conversations.members':
+            return self.send({'ok': True, 'members': ['U1'], 'response_metadata': {'next_cursor': ''}})
+        if method in ('users.list', 'users.info'):
+            user = {'id': 'U1', 'name': 'me'}
+            if method == 'users.info':
+                return self.send({'ok': True, 'user': user})
+            return self.send({'ok': True, 'members': [user], 'response_metadata': {'next_cursor': ''}})
+        if method == 'conversations.history':
+            self.server.historyRequests.append((query['channel'], query.get('cursor')))
+            page = int(query.get('cursor') or 0)
+            if page == 2 and self.server.failing:
+                self.server.failing = False
+                return self.send({'ok': False, 'error': 'internal_error'}, 500)
+            messages = list(reversed(self.history)) if query['channel'] == 'C1' else []
+            start = page * self.pageSize
+            more = start + self.pageSize < len(messages)
+            return self.send({'ok': True, 'messages': messages[start:start + self.pageSize], 'has_more': more,
+                              'response_metadata': {'next_cursor': str(page + 1) if more else ''}})
+        if method == 'conversations.replies':
+            return self.send({'ok': True, 'messages': self.replies, 'response_metadata': {'next_cursor': ''}})
+        self.send({'ok': False, 'error': 'unknown_method'})
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockWorkspaceHandler)
+        self.server.historyRequests = []
+        self.server.failing = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.directory.name)
+
+    # runs the script against the mock workspace, returning its exit status
+    def export(self, *arguments):
+        request = requests.Session.request
+        apiUrl = 'http://127.0.0.1:%d/api/' % self.server.server_port
+
+        def toMock(session, method, url, *args, **kwargs):
+            return request(session, method, url.replace(slack_export.API_URL, apiUrl), *args, **kwargs)
+
+        script = os.path.join(os.path.dirname(os.path.abspath(slack_export.__file__)), 'slack_export.py')
+        with mock.patch.object(requests.Session, 'request', toMock), \
+                mock.patch('sys.argv', ['slack_export.py', '--token', 'xoxb-test'] + list(arguments)), \
+                contextlib.redirect_stdout(io.StringIO()), \
+                self.assertRaises(SystemExit) as exited:
+            runpy.run_path(script, run_name='__main__')
+        os.chdir(self.directory.name)
+        return exited.exception.code
+
+    def test_resume_after_crash(self):
+        self.assertEqual(self.export('--publicChannels', 'general', '--compress', 'gzip'), 1)
+        exportDirectory, = glob.glob(os.path.join(self.directory.name, '*-slack_export'))
+        self.assertEqual(self.server.historyRequests, [('C1', None), ('C1', '1'), ('C1', '2')])
+
+        # a crash between logging messages and saving the state after them
+        # leaves them past the logged size, where they are dropped on resume
+        log = os.path.join(exportDirectory, '.checkpoint', 'C1', 'messages.jsonl')
+        with open(log, 'rb') as inFile:
+            lastLine = inFile.read().splitlines()[-1]
+        with open(log, 'ab') as outFile:
+            outFile.write(lastLine + b'\n{"ts": "17')
+
+        self.server.historyRequests = []
+        self.assertEqual(self.export('--resume', exportDirectory), 0)
+        # the finished pages aren't fetched again, nor is random, which wasn't selected
+        self.assertEqual(self.server.historyRequests, [('C1', '2'), ('C1', '3'), ('C1', '4')])
+
+        dayFiles = glob.glob(os.path.join(exportDirectory, 'general', '*'))
+        self.assertTrue(dayFiles)
+        self.assertTrue(all(dayFile.endswith('.json.gz') for dayFile in dayFiles))
+        self.assertFalse(os.path.exists(os.path.join(exportDirectory, 'random')))
+        texts = collections.Counter(message['text'] for dayFile in dayFiles for message in readJsonFile(dayFile))
+        expected = [message['text'] for message in MockWorkspaceHandler.history + MockWorkspaceHandler.replies[1:]]
+        self.assertEqual(texts, collections.Counter(expected))
+        self.assertFalse(os.path.exists(os.path.join(exportDirectory, '.checkpoint')))
+
+
+if __name__ == '__main__':
+    unittest.main()